@@ -1,14 +1,28 @@
-from flask import Flask, request, send_file, render_template_string, redirect, url_for, flash, session
+from flask import Flask, request, send_file, render_template, redirect, url_for, flash, session, jsonify, g
+from werkzeug.datastructures import FileStorage
+from werkzeug.middleware.proxy_fix import ProxyFix
 import fitz  # PyMuPDF
-from PIL import Image, ImageDraw, ImageFont
-import os, uuid, random, re, shutil, json, hashlib, sqlite3, time
+from PIL import Image, ImageChops, ImageDraw, ImageFont, features
+import os, uuid, random, re, shutil, json, hashlib, sqlite3, time, threading, zipfile, secrets, tempfile, math
 import pytesseract
-from datetime import datetime, timedelta
-from ethiopian_date import EthiopianDateConverter
-from functools import wraps
-import qrcode
+from datetime import datetime, timedelta, date
+from functools import wraps, lru_cache
+import segno
 from io import BytesIO
 import base64
+from collections import OrderedDict
+import numpy as np
+import click
+
+try:
+    import onnxruntime
+except ImportError:  # only needed for BG_ENGINE=onnx
+    onnxruntime = None
+
+try:
+    import cv2
+except ImportError:  # only needed for PHOTO_AUTO_CROP
+    cv2 = None
 
 app = Flask(__name__)
 app.secret_key = 'free_service_secret_key_2024'  # Secret key free version
@@ -17,16 +31,171 @@ app.secret_key = 'free_service_secret_key_2024'  # Secret key free version
 UPLOAD_FOLDER = "uploads"
 IMG_FOLDER = "extracted_images"
 CARD_FOLDER = "cards"
+THUMB_FOLDER = "thumbnails"
 DB_PATH = "database.db"
 FONT_PATH = "fonts/AbyssinicaSIL-Regular.ttf"
 TEMPLATE_PATH = "static/id_card_template.png"
 
+# Card templates: every layout file in LAYOUT_FOLDER is a template, its id being
+# the file name. A layout names its template bitmap and font, see compile_layout()
+LAYOUT_FOLDER = "layouts"
+LAYOUT_VERSION = 1
+DEFAULT_TEMPLATE_ID = os.environ.get("CARD_TEMPLATE", "fayda_v1")
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", "2"))  # templates kept decoded per worker
+TEMPLATE_SCALES_PER_TEMPLATE = 4  # scaled bitmaps (previews) kept per template
+
+# Cards never change once generated, so browsers may keep them for a year
+CARD_CACHE_MAX_AGE = 365 * 24 * 3600
+
 # FREE SERVICE - NO PAYMENT REQUIRED
 FREE_MODE = True  # Hardcoded FREE mode
 
-for folder in [UPLOAD_FOLDER, IMG_FOLDER, CARD_FOLDER]:
+# Dashboard previews: small WebP (JPEG where Pillow lacks WebP) copies of each card
+THUMB_WIDTH = 360
+THUMB_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+THUMB_MIMETYPE = "image/webp" if THUMB_FORMAT == "WEBP" else "image/jpeg"
+
+# Background removal: "threshold" (fast, default) or "onnx" (U2-Net style segmentation model,
+# e.g. the u2netp.onnx that rembg downloads into ~/.u2net)
+BG_ENGINE = os.environ.get("BG_ENGINE", "threshold")
+BG_MODEL_PATH = os.environ.get("BG_MODEL_PATH", os.path.expanduser("~/.u2net/u2netp.onnx"))
+BG_MODEL_INPUT_SIZE = 320
+BG_CACHE_SIZE = 64
+
+# Auto-crop of uploaded photos to the card slot's shape around the largest
+# face (OpenCV Haar cascade). Photos without a face, or already cropped ones,
+# are kept as they are. Off unless PHOTO_AUTO_CROP=1.
+PHOTO_AUTO_CROP = os.environ.get("PHOTO_AUTO_CROP", "0") == "1"
+FACE_DETECT_WIDTH = 320       # the cascade runs on a grayscale copy this wide
+FACE_CROP_WIDTH = 2.2         # crop width, in face widths
+FACE_CROP_HEADROOM = 0.6      # space kept above the face, in face heights
+FACE_CROP_MAX_AREA = 0.8      # crops keeping more of the photo than this are skipped
+FACE_CROP_CACHE_SIZE = 256
+
+# Uploaded photos are stored at most this large (twice the 530x550 card slot)
+UPLOAD_PHOTO_MAX_SIZE = (1060, 1100)
+
+# Pre-flight limits on uploaded PDFs, checked before any image is extracted
+PDF_MAX_BYTES = 10 * 1024 * 1024
+PDF_MAX_PAGES = 8
+PDF_MAX_IMAGES = 24
+
+# Decoding budgets. No image is decoded to more than IMAGE_MAX_PIXELS (~96 MB
+# as RGBA): larger JPEGs are decoded at a reduced scale, anything else larger
+# is refused from its header. PIL's own header check stays as a backstop for
+# JPEGs too large even for 1/8 scale decoding.
+IMAGE_MAX_PIXELS = 24_000_000
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS * 32
+PHOTO_MAX_BYTES = 15 * 1024 * 1024
+
+# Request bodies: never more than a PDF and a photo; bodies are read into
+# memory only up to UPLOAD_SPOOL_MEMORY and spooled to a temporary file beyond
+MAX_CONTENT_LENGTH = PDF_MAX_BYTES + PHOTO_MAX_BYTES + 1024 * 1024
+UPLOAD_SPOOL_MEMORY = 512 * 1024
+
+# Extracted fields + photo per PDF (keyed by SHA-256), least recently used evicted first
+PDF_CACHE_MAX_BYTES = 200 * 1024 * 1024
+PDF_CACHE_MAX_ENTRIES = 5000
+
+# Full resolution layer stacks of recent cards kept per worker for field edits
+CARD_JOB_CACHE_SIZE = 4
+
+# SHA-256 of served files per (path, mtime, size), least recently used evicted first
+CONTENT_HASH_CACHE_SIZE = 4096
+
+# Print sheets. A card image holds the front (left) and back (right) side; the
+# boxes are in card pixels and each side is printed at CR80 size (85.6 x 54 mm).
+CARD_FRONT_BOX = (0, 0, 1020, 655)
+CARD_BACK_BOX = (1100, 0, 2130, 655)
+CR80_SIZE = (242.65, 153.07)  # points
+SHEET_LAYOUTS = {
+    # A4 portrait: whole cards (front and back side by side) stacked 5 per page
+    "a4": {"page": (595.28, 841.89), "columns": 1, "rows": 5, "sides": False},
+    # One CR80 page per side, front then back, for card printers with duplex
+    "cr80": {"page": CR80_SIZE, "columns": 1, "rows": 1, "sides": True},
+}
+SHEET_FLUSH_PAGES = 25
+
+# Idempotency keys: a repeated /generate or API request with the same key
+# returns the card of the first one instead of rendering (and counting) again
+IDEMPOTENCY_TTL = 24 * 3600
+IDEMPOTENCY_KEY_PATTERN = r"[\x21-\x7e]{8,128}"  # printable ASCII, no spaces
+
+# JSON API: card history pages (keyset pagination, newest first)
+API_PAGE_SIZE = 50
+API_PAGE_MAX = 200
+
+# ZIP export of a user's cards: streamed in chunks, compressed formats stored as is
+ZIP_CHUNK_SIZE = 256 * 1024
+ZIP_STORED_EXTENSIONS = (".png", ".pdf", ".jpg", ".jpeg", ".webp")
+
+# Vector card output: the card laid out in points, each pixel at its CR80 print size
+CARD_OUTPUT_FORMATS = ("png", "pdf")
+CARD_PT_PER_PX = CR80_SIZE[0] / (CARD_FRONT_BOX[2] - CARD_FRONT_BOX[0])
+CARD_PDF_FONT = "abyssinica"
+
+# Live progress of /generate requests (server-sent events), kept per worker
+PROGRESS_TTL = 600          # forget a generation's events after this many seconds
+PROGRESS_KEEPALIVE = 15     # comment line sent while a stage is still running
+PROGRESS_TIMEOUT = 300      # longest a progress stream stays open
+
+# Token bucket rate limit on card generation, per user and per client IP:
+# BURST requests at once, refilled at RATE per second. Buckets live in worker
+# memory unless RATE_LIMIT_DB names an SQLite file shared by all workers.
+RATE_LIMIT_RATE = float(os.environ.get("RATE_LIMIT_RATE", "0.2"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB", "")
+RATE_LIMIT_MAX_KEYS = 10000  # idle full buckets are dropped past this many
+
+# Reverse proxies in front of the app (1 on Render). Their X-Forwarded-For,
+# -Proto and -Host headers are trusted that many hops deep, so remote_addr is
+# the client and not the proxy, which would put every client in one rate limit
+# bucket. With 0 the headers are ignored: only set it when there is a proxy.
+PROXY_FIX_HOPS = int(os.environ.get("PROXY_FIX_HOPS", "0"))
+
+# Auto-fit of long field values: smallest font size a field may shrink to,
+# and how many (text, size) measurements are memoized
+FIT_MIN_SIZE = 16
+TEXT_EXTENT_CACHE_SIZE = 8192
+
+# Ethiopian calendar: Gregorian days in this range convert by table lookup,
+# others by the same arithmetic the table is built with
+ETHIOPIAN_TABLE_RANGE = (date(1900, 1, 1), date(2099, 12, 31))
+ETHIOPIAN_EPOCH = 2796  # date.toordinal() of 1 Meskerem 1 (Amete Mihret), 29 August 8 Julian
+CARD_VALIDITY_YEARS = 8
+
+# QR block of a layout: modules are whole pixels, with a light margin of
+# this many modules; rendered codes are cached per payload and size
+QR_QUIET_ZONE = 2
+QR_CACHE_SIZE = 256
+QR_PDF_OVERSAMPLE = 4  # the PDF embeds the code at this many times its card pixel size
+QR_MASK = 2  # fixed data mask; scoring all eight is ~80% of segno's encoding time
+
+# Rasterized text of card fields, shared by all cards and templates; the
+# least recently used sprites are dropped past this many bytes of pixels
+TEXT_SPRITE_CACHE_BYTES = 16 * 1024 * 1024
+TEXT_SPRITE_MAX_BYTES = TEXT_SPRITE_CACHE_BYTES // 16  # larger sprites are drawn but never cached
+
+# Low resolution previews of the card layout, rendered before the full card
+PREVIEW_SCALE = 0.25
+PREVIEW_SCALES = (0.125, 0.25, 0.5)  # ?scale= snaps to the nearest, so scaled templates stay cached
+
+# How long each kind of file is kept before the janitor removes it (seconds)
+ARTIFACT_TTL = {
+    "upload": 3600,            # uploaded PDFs
+    "image": 3600,             # extracted and uploaded photos
+    "card": 7 * 24 * 3600,     # generated cards (and their thumbnails)
+}
+JANITOR_INTERVAL = 60
+JANITOR_BATCH_SIZE = 200
+
+for folder in [UPLOAD_FOLDER, IMG_FOLDER, CARD_FOLDER, THUMB_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+if PROXY_FIX_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_FIX_HOPS, x_proto=PROXY_FIX_HOPS, x_host=PROXY_FIX_HOPS)
+
 # 2. DATABASE SETUP - FREE VERSION
 def init_db():
     conn = sqlite3.connect(DB_PATH)
@@ -56,9 +225,48 @@ def init_db():
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER NOT NULL,
                   card_path TEXT NOT NULL,
+                  content_hash TEXT,
+                  expired INTEGER DEFAULT 0,
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  FOREIGN KEY (user_id) REFERENCES users (id))''')
+    
+    # Files waiting to be deleted by the janitor, oldest expiry first
+    c.execute('''CREATE TABLE IF NOT EXISTS artifacts
+                 (path TEXT PRIMARY KEY,
+                  kind TEXT NOT NULL,
+                  size INTEGER DEFAULT 0,
+                  expires_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_artifacts_expires ON artifacts (expires_at)")
+    
+    # Extraction results per uploaded PDF, so a resubmitted PDF is never parsed twice
+    c.execute('''CREATE TABLE IF NOT EXISTS pdf_cache
+                 (pdf_hash TEXT PRIMARY KEY,
+                  fields TEXT NOT NULL,
+                  photo BLOB,
+                  size INTEGER DEFAULT 0,
+                  last_used REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pdf_cache_last_used ON pdf_cache (last_used)")
+    
+    # API tokens for the JSON API; only a SHA-256 of each token is stored
+    c.execute('''CREATE TABLE IF NOT EXISTS api_tokens
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  user_id INTEGER NOT NULL,
+                  token_hash TEXT UNIQUE NOT NULL,
+                  name TEXT,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  last_used TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
     
+    # Result of the first request made with each idempotency key
+    c.execute('''CREATE TABLE IF NOT EXISTS idempotency_keys
+                 (user_id INTEGER NOT NULL,
+                  key TEXT NOT NULL,
+                  fingerprint TEXT NOT NULL,
+                  result TEXT NOT NULL,
+                  expires_at REAL NOT NULL,
+                  PRIMARY KEY (user_id, key))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at)")
+    
     # Password reset tokens
     c.execute('''CREATE TABLE IF NOT EXISTS password_resets
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -78,6 +286,18 @@ def init_db():
         print("Adding free_cards_generated column to users table...")
         c.execute("ALTER TABLE users ADD COLUMN free_cards_generated INTEGER DEFAULT 0")
     
+    # Check if content_hash column exists (used as the download ETag)
+    c.execute("PRAGMA table_info(cards_generated)")
+    columns = [col[1] for col in c.fetchall()]
+    if 'content_hash' not in columns:
+        print("Adding content_hash column to cards_generated table...")
+        c.execute("ALTER TABLE cards_generated ADD COLUMN content_hash TEXT")
+    if 'expired' not in columns:
+        print("Adding expired column to cards_generated table...")
+        c.execute("ALTER TABLE cards_generated ADD COLUMN expired INTEGER DEFAULT 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cards_generated_path ON cards_generated (card_path)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cards_generated_user ON cards_generated (user_id, id)")
+    
     # Check if old tables exist and remove them if needed
     c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='transactions'")
     if c.fetchone():
@@ -97,6 +317,8 @@ def init_db():
                          (id INTEGER PRIMARY KEY AUTOINCREMENT,
                           user_id INTEGER NOT NULL,
                           card_path TEXT NOT NULL,
+                          content_hash TEXT,
+                          expired INTEGER DEFAULT 0,
                           created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                           FOREIGN KEY (user_id) REFERENCES users (id))''')
     
@@ -130,20 +352,464 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def clear_old_files():
-    """Foldaroota qulqulleessuu"""
-    for folder in [UPLOAD_FOLDER, IMG_FOLDER, CARD_FOLDER]:
-        for filename in os.listdir(folder):
-            file_path = os.path.join(folder, filename)
-            try:
-                if os.path.isfile(file_path):
+_buckets = {}
+_buckets_lock = threading.Lock()
+_rate_limit_db = threading.local()
+
+def _take_from_buckets(buckets, keys, now, cost):
+    """Debit cost from every bucket of keys if all hold enough tokens.
+
+    buckets maps key -> (tokens, updated). Returns the new values to store,
+    or the seconds until the emptiest bucket has refilled enough.
+    """
+    levels = {}
+    for key in keys:
+        tokens, updated = buckets.get(key, (RATE_LIMIT_BURST, now))
+        levels[key] = min(RATE_LIMIT_BURST, tokens + (now - updated) * RATE_LIMIT_RATE)
+    short = max(cost - tokens for tokens in levels.values())
+    if short > 0:
+        return short / RATE_LIMIT_RATE if RATE_LIMIT_RATE > 0 else float("inf")
+    return {key: (tokens - cost, now) for key, tokens in levels.items()}
+
+def _shared_rate_limit_db():
+    conn = getattr(_rate_limit_db, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(RATE_LIMIT_DB, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated)")
+        _rate_limit_db.conn = conn
+    return conn
+
+def rate_limit_take(keys, cost=1.0):
+    """Spend cost tokens from the bucket of each key; all or nothing.
+
+    Returns 0 when allowed, otherwise the seconds to wait before retrying.
+    """
+    now = time.time() if RATE_LIMIT_DB else time.monotonic()
+    if RATE_LIMIT_DB:
+        conn = _shared_rate_limit_db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(f"SELECT key, tokens, updated FROM buckets WHERE key IN ({','.join('?' * len(keys))})",
+                                keys).fetchall()
+            taken = _take_from_buckets({key: (tokens, updated) for key, tokens, updated in rows}, keys, now, cost)
+            if isinstance(taken, dict):
+                conn.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                                 [(key, tokens, updated) for key, (tokens, updated) in taken.items()])
+        finally:
+            conn.execute("COMMIT")
+    else:
+        with _buckets_lock:
+            taken = _take_from_buckets(_buckets, keys, now, cost)
+            if isinstance(taken, dict):
+                _buckets.update(taken)
+                if len(_buckets) > RATE_LIMIT_MAX_KEYS:
+                    full_after = RATE_LIMIT_BURST / RATE_LIMIT_RATE if RATE_LIMIT_RATE > 0 else float("inf")
+                    for key in [key for key, (_, updated) in _buckets.items() if now - updated >= full_after]:
+                        del _buckets[key]
+    return 0 if isinstance(taken, dict) else taken
+
+def rate_limited(f):
+    """Answer 429 to POSTs of a user (session or API token) or IP that is out of tokens"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'POST':
+            keys = [f"ip:{request.remote_addr}"]
+            user_id = session.get('user_id') or g.get('api_user_id')
+            if user_id:
+                keys.append(f"user:{user_id}")
+            wait = rate_limit_take(keys)
+            if wait:
+                retry_after = str(int(wait) + 1)
+                message = f"Too many requests, try again in {retry_after} seconds"
+                if request.path.startswith("/api/"):
+                    return jsonify({"error": message}), 429, {"Retry-After": retry_after}
+                return message, 429, {"Retry-After": retry_after}
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Artifact expiry: every file we write is recorded in the artifacts table with
+# its expiry time, so the janitor only ever reads the rows that are due.
+JANITOR_STATS = {"passes": 0, "files_deleted": 0, "bytes_reclaimed": 0, "cards_expired": 0}
+_janitor_started = False
+_janitor_lock = threading.Lock()
+
+def register_artifacts(paths, kind):
+    """Schedule files for deletion after ARTIFACT_TTL[kind] seconds"""
+    expires_at = time.time() + ARTIFACT_TTL[kind]
+    rows = []
+    for path in paths:
+        if path and os.path.exists(path):
+            rows.append((path, kind, os.path.getsize(path), expires_at))
+    if not rows:
+        return
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.executemany("INSERT OR REPLACE INTO artifacts (path, kind, size, expires_at) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+def run_janitor_pass(now=None, batch_size=JANITOR_BATCH_SIZE):
+    """Delete expired artifacts in batches of at most batch_size files.
+
+    Each batch is claimed inside one write transaction, so several workers
+    running their own janitor never delete the same row twice.
+    Returns (files_deleted, bytes_reclaimed).
+    """
+    now = now or time.time()
+    total_files = total_bytes = 0
+    while True:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT path, kind, size FROM artifacts WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                  (now, batch_size))
+        batch = c.fetchall()
+        c.executemany("DELETE FROM artifacts WHERE path = ?", [(row[0],) for row in batch])
+        cards = [(row[0],) for row in batch if row[1] == "card"]
+        c.executemany("UPDATE cards_generated SET expired = 1 WHERE card_path = ?", cards)
+        conn.commit()
+        conn.close()
+        
+        for path, kind, size in batch:
+            paths = [path, thumbnail_path_for(path)] if kind == "card" else [path]
+            for file_path in paths:
+                try:
+                    file_size = size if file_path == path else os.path.getsize(file_path)
                     os.remove(file_path)
-            except Exception as e:
-                print(f"Error deleting {file_path}: {e}")
+                except FileNotFoundError:
+                    continue
+                except Exception as e:
+                    print(f"Error deleting {file_path}: {e}")
+                    continue
+                total_files += 1
+                total_bytes += file_size
+        JANITOR_STATS["cards_expired"] += len(cards)
+        
+        if len(batch) < batch_size:
+            break
+    
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+    conn.commit()
+    conn.close()
+    
+    if RATE_LIMIT_DB and RATE_LIMIT_RATE > 0:
+        # A bucket idle long enough to have refilled is the same as no bucket
+        _shared_rate_limit_db().execute("DELETE FROM buckets WHERE updated <= ?",
+                                        (now - RATE_LIMIT_BURST / RATE_LIMIT_RATE,))
+    
+    JANITOR_STATS["passes"] += 1
+    JANITOR_STATS["files_deleted"] += total_files
+    JANITOR_STATS["bytes_reclaimed"] += total_bytes
+    if total_files:
+        print(f"Janitor: deleted {total_files} files, reclaimed {total_bytes / 1024 / 1024:.1f} MB")
+    return total_files, total_bytes
+
+def _janitor_loop():
+    while True:
+        try:
+            run_janitor_pass()
+        except Exception as e:
+            print(f"Janitor error: {e}")
+        time.sleep(JANITOR_INTERVAL)
+
+def start_janitor():
+    """Start the background janitor thread once per worker process"""
+    global _janitor_started
+    with _janitor_lock:
+        if _janitor_started:
+            return
+        threading.Thread(target=_janitor_loop, name="janitor", daemon=True).start()
+        _janitor_started = True
 
 def generate_transaction_id():
     return f"FREE_{uuid.uuid4().hex[:8].upper()}_{int(time.time())}"
 
+_content_hashes = OrderedDict()
+_content_hashes_lock = threading.Lock()
+
+def file_content_hash(path):
+    """SHA-256 of a file, remembered per (path, mtime, size) so it is read once"""
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    with _content_hashes_lock:
+        digest = _content_hashes.get(key)
+        if digest is not None:
+            _content_hashes.move_to_end(key)
+            return digest
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _content_hashes_lock:
+        _content_hashes[key] = digest
+        while len(_content_hashes) > CONTENT_HASH_CACHE_SIZE:
+            _content_hashes.popitem(last=False)
+    return digest
+
+def set_immutable_cache_headers(response, etag):
+    response.set_etag(etag)
+    response.cache_control.public = None
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    response.cache_control.max_age = CARD_CACHE_MAX_AGE
+    return response
+
+def send_immutable_file(path, mimetype, etag, download_name=None, as_attachment=False):
+    """send_file for content that never changes: strong ETag, 304s and ranges.
+
+    A matching If-None-Match is answered before the file is even opened.
+    """
+    if request.if_none_match.contains(etag):
+        return set_immutable_cache_headers(app.response_class(status=304), etag)
+    response = send_file(path, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+                         etag=etag, conditional=True, max_age=CARD_CACHE_MAX_AGE)
+    return set_immutable_cache_headers(response, etag)
+
+def card_mimetype(card_path):
+    return 'application/pdf' if card_path.endswith(".pdf") else 'image/png'
+
+def thumbnail_path_for(card_path):
+    name = os.path.splitext(os.path.basename(card_path))[0]
+    return os.path.join(THUMB_FOLDER, f"{name}.{THUMB_FORMAT.lower().replace('jpeg', 'jpg')}")
+
+def save_card_thumbnail(card, card_path):
+    """Write the dashboard thumbnail for a card from an already decoded image"""
+    thumb = card.convert("RGB")
+    factor = thumb.width // (THUMB_WIDTH * 2)
+    if factor > 1:
+        thumb = thumb.reduce(factor)
+    thumb = thumb.resize((THUMB_WIDTH, round(thumb.height * THUMB_WIDTH / thumb.width)), Image.LANCZOS)
+    thumb_path = thumbnail_path_for(card_path)
+    thumb.save(thumb_path, THUMB_FORMAT, quality=80)
+    return thumb_path
+
+def open_photo_near(path, size):
+    """Open a photo decoded as close to `size` as the format allows.
+
+    JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale through draft(), other
+    formats are shrunk by an integer factor with reduce(), so nothing is ever
+    resized or processed at full camera resolution.  The result is never
+    smaller than `size`.
+    Only the header has been read when the pixel budget is checked; raises
+    Image.DecompressionBombError for images that would decode larger than
+    IMAGE_MAX_PIXELS.
+    """
+    img = Image.open(path)
+    if img.format == "JPEG":
+        img.draft("RGB", size)
+        if img.width * img.height > IMAGE_MAX_PIXELS:
+            # Still too large at the scale draft() picked: force 1/8
+            img.draft("RGB", (img.width // 8, img.height // 8))
+    if img.width * img.height > IMAGE_MAX_PIXELS:
+        raise Image.DecompressionBombError(
+            f"Image of {img.width}x{img.height} pixels is over the {IMAGE_MAX_PIXELS} pixel budget")
+    if img.format != "JPEG":
+        if img.mode not in ("L", "LA", "RGB", "RGBA"):
+            img = img.convert("RGBA")
+        factor = min(img.width // size[0], img.height // size[1])
+        if factor > 1:
+            img = img.reduce(factor)
+    return img
+
+def load_photo(path, size):
+    """Decode a photo near `size` and resize it to exactly `size`, as RGBA; decoded images are only resized"""
+    img = path if isinstance(path, Image.Image) else open_photo_near(path, size)
+    return img.convert("RGBA").resize(size)
+
+def remove_white_background(img):
+    """Make near-white pixels (all channels > 220) fully transparent"""
+    img = img.convert("RGBA")
+    r, g, b, _ = img.split()
+    white = lambda v: 255 if v > 220 else 0
+    mask = ImageChops.darker(ImageChops.darker(r.point(white), g.point(white)), b.point(white))
+    img.paste((255, 255, 255, 0), None, mask)
+    return img
+
+# Background removal engines. Each takes a list of RGBA images and returns the
+# same images with the background made transparent, so callers can batch.
+def threshold_engine(images):
+    return [remove_white_background(img) for img in images]
+
+_onnx_session = None
+_onnx_session_lock = threading.Lock()
+_onnx_batching = True
+
+def get_onnx_session():
+    """The segmentation model, loaded once per worker process.
+
+    A model exported with a fixed batch size (an int batch dimension) is run
+    one image at a time; a symbolic one takes all images in one call.
+    """
+    global _onnx_session, _onnx_batching
+    if _onnx_session is None:
+        with _onnx_session_lock:
+            if _onnx_session is None:
+                if onnxruntime is None:
+                    raise RuntimeError("BG_ENGINE=onnx needs the onnxruntime package")
+                options = onnxruntime.SessionOptions()
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+                session = onnxruntime.InferenceSession(BG_MODEL_PATH, options, providers=["CPUExecutionProvider"])
+                _onnx_batching = not isinstance(session.get_inputs()[0].shape[0], int)
+                _onnx_session = session
+    return _onnx_session
+
+def onnx_engine(images):
+    """Segment all images with one inference call on BG_MODEL_INPUT_SIZE inputs"""
+    session = get_onnx_session()
+    size = (BG_MODEL_INPUT_SIZE, BG_MODEL_INPUT_SIZE)
+    mean = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+    std = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+    
+    batch = []
+    for img in images:
+        pixels = np.asarray(img.convert("RGB").resize(size, Image.BILINEAR), dtype=np.float32)
+        pixels = (pixels / max(pixels.max(), 1e-6) - mean) / std
+        batch.append(pixels.transpose((2, 0, 1)))
+    batch = np.stack(batch).astype(np.float32)
+    
+    input_name = session.get_inputs()[0].name
+    if _onnx_batching:
+        predictions = session.run(None, {input_name: batch})[0][:, 0]
+    else:
+        predictions = np.concatenate([session.run(None, {input_name: item[None]})[0][:, 0] for item in batch])
+    
+    results = []
+    for img, pred in zip(images, predictions):
+        pred = (pred - pred.min()) / max(pred.max() - pred.min(), 1e-6)
+        mask = Image.fromarray((pred * 255).astype(np.uint8), "L").resize(img.size, Image.BILINEAR)
+        result = img.convert("RGBA")
+        result.putalpha(ImageChops.multiply(result.getchannel("A"), mask))
+        results.append(result)
+    return results
+
+BG_ENGINES = {
+    "threshold": threshold_engine,
+    "onnx": onnx_engine,
+}
+
+_bg_cache = OrderedDict()
+_bg_cache_lock = threading.Lock()
+
+def remove_backgrounds(images, engine=None):
+    """Remove the background of several photos with the configured engine.
+
+    Results are cached by (engine, photo pixel hash); only cache misses are
+    sent to the engine, in a single batch.
+    """
+    engine = engine or BG_ENGINE
+    keys = [(engine, hashlib.sha256(img.tobytes()).hexdigest(), img.size) for img in images]
+    results = {}
+    with _bg_cache_lock:
+        for key in keys:
+            if key in _bg_cache:
+                _bg_cache.move_to_end(key)
+                results[key] = _bg_cache[key]
+    
+    missing = [(key, img) for key, img in zip(keys, images) if key not in results]
+    if missing:
+        cleaned = BG_ENGINES[engine]([img for _, img in missing])
+        with _bg_cache_lock:
+            for (key, _), img in zip(missing, cleaned):
+                results[key] = _bg_cache[key] = img
+            while len(_bg_cache) > BG_CACHE_SIZE:
+                _bg_cache.popitem(last=False)
+    return [results[key].copy() for key in keys]
+
+_face_detector = None
+_face_detector_lock = threading.Lock()
+_face_crops = OrderedDict()
+_face_crops_lock = threading.Lock()
+
+def get_face_detector():
+    """The frontal face cascade, loaded once per worker process"""
+    global _face_detector
+    if _face_detector is None:
+        with _face_detector_lock:
+            if _face_detector is None:
+                if cv2 is None:
+                    raise RuntimeError("PHOTO_AUTO_CROP needs the opencv-python-headless package")
+                detector = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades,
+                                                              "haarcascade_frontalface_default.xml"))
+                if detector.empty():
+                    raise RuntimeError("Could not load the OpenCV face cascade")
+                _face_detector = detector
+    return _face_detector
+
+def face_crop_box(img):
+    """Crop box around the largest face, as fractions of the photo size, or None.
+
+    Detection runs on a small grayscale copy; the box has the card slot's
+    shape (UPLOAD_PHOTO_MAX_SIZE) and stays inside the photo.
+    """
+    width, height = img.size
+    ratio = min(1.0, FACE_DETECT_WIDTH / width)
+    small = img.convert("L")
+    if ratio < 1.0:
+        small = small.resize((FACE_DETECT_WIDTH, max(1, round(height * ratio))), Image.BILINEAR, reducing_gap=2.0)
+    faces = get_face_detector().detectMultiScale(np.asarray(small), scaleFactor=1.15, minNeighbors=5)
+    if len(faces) == 0:
+        return None
+    x, y, w, h = (int(v) / ratio for v in max(faces, key=lambda face: face[2] * face[3]))
+    
+    crop_w = w * FACE_CROP_WIDTH
+    crop_h = crop_w * UPLOAD_PHOTO_MAX_SIZE[1] / UPLOAD_PHOTO_MAX_SIZE[0]
+    fit = min(1.0, width / crop_w, height / crop_h)
+    crop_w, crop_h = crop_w * fit, crop_h * fit
+    if crop_w * crop_h > FACE_CROP_MAX_AREA * width * height:
+        return None
+    left = min(max(0, x + w / 2 - crop_w / 2), width - crop_w)
+    top = min(max(0, y - h * FACE_CROP_HEADROOM), height - crop_h)
+    return (left / width, top / height, (left + crop_w) / width, (top + crop_h) / height)
+
+def photo_face_box(path, photo_hash=None):
+    """face_crop_box() of a photo file (or stream), cached by photo hash.
+
+    Detection only needs FACE_DETECT_WIDTH pixels, so it runs on a draft
+    decode: 1/8 scale for a camera JPEG.
+    """
+    with _face_crops_lock:
+        hit = photo_hash in _face_crops
+        if hit:
+            box = _face_crops[photo_hash]
+            _face_crops.move_to_end(photo_hash)
+    if not hit:
+        with open_photo_near(path, (FACE_DETECT_WIDTH, 1)) as draft:
+            box = face_crop_box(draft)
+        if photo_hash:
+            with _face_crops_lock:
+                _face_crops[photo_hash] = box
+                while len(_face_crops) > FACE_CROP_CACHE_SIZE:
+                    _face_crops.popitem(last=False)
+    return box
+
+def open_cropped_photo(path, photo_hash=None, size=UPLOAD_PHOTO_MAX_SIZE):
+    """Open a photo cropped around its face, decoded so that the crop still covers `size`.
+
+    The face is found on a draft (photo_face_box()); the draft scale of the
+    real decode is then picked from the size of the crop box, not of the
+    whole photo. Without a face (or without OpenCV) this is open_photo_near().
+    """
+    try:
+        box = photo_face_box(path, photo_hash)
+    except Image.DecompressionBombError:
+        raise
+    except Exception as e:
+        print(f"Photo auto-crop skipped: {e}")
+        box = None
+    if box is None:
+        return open_photo_near(path, size)
+    with Image.open(path) as header:
+        width, height = header.size
+    img = open_photo_near(path, (min(width, math.ceil(size[0] / (box[2] - box[0]))),
+                                 min(height, math.ceil(size[1] / (box[3] - box[1])))))
+    width, height = img.size
+    return img.crop((round(box[0] * width), round(box[1] * height), round(box[2] * width), round(box[3] * height)))
+
 def save_user_uploaded_image(uploaded_file):
     if not uploaded_file or uploaded_file.filename == '':
         return None
@@ -162,20 +828,23 @@ def save_user_uploaded_image(uploaded_file):
         elif filename.endswith('.tiff'):
             ext = 'tiff'
         
+        size = uploaded_file_size(uploaded_file)
+        if size > PHOTO_MAX_BYTES:
+            print(f"Uploaded image refused: {size} bytes, at most {PHOTO_MAX_BYTES}")
+            return None
+        
+        photo_hash = hash_uploaded_file(uploaded_file) if PHOTO_AUTO_CROP else None
         img_name = f"page2_img0_{unique_id}.{ext}"
         save_path = os.path.join(IMG_FOLDER, img_name)
         uploaded_file.save(save_path)
         
         try:
-            img = Image.open(save_path).convert("RGBA")
-            datas = img.getdata()
-            newData = []
-            for item in datas:
-                if item[0] > 220 and item[1] > 220 and item[2] > 220:
-                    newData.append((255, 255, 255, 0))
-                else:
-                    newData.append(item)
-            img.putdata(newData)
+            # Only ever shown at 530x550, so keep at most twice that
+            if PHOTO_AUTO_CROP:
+                img = open_cropped_photo(save_path, photo_hash)
+            else:
+                img = open_photo_near(save_path, UPLOAD_PHOTO_MAX_SIZE)
+            img.thumbnail(UPLOAD_PHOTO_MAX_SIZE)
             
             png_path = os.path.join(IMG_FOLDER, f"page2_img0_{unique_id}.png")
             img.save(png_path, "PNG")
@@ -184,9 +853,15 @@ def save_user_uploaded_image(uploaded_file):
                 os.remove(save_path)
                 save_path = png_path
             
+            register_artifacts([save_path], "image")
             return save_path
+        except Image.DecompressionBombError as e:
+            print(f"Uploaded image refused: {e}")
+            os.remove(save_path)
+            return None
         except Exception as e:
             print(f"Error processing uploaded image: {e}")
+            register_artifacts([save_path], "image")
             return save_path
     
     return None
@@ -215,7 +890,11 @@ def extract_all_images(pdf_path):
         image_list = page.get_images(full=True)
         
         for img_index, img in enumerate(image_list):
-            xref = img[0]
+            xref, width, height = img[0], img[2], img[3]
+            if width * height > IMAGE_MAX_PIXELS:
+                # extract_image() would decode it to re-encode it as PNG
+                print(f"Skipping PDF image {xref}: {width}x{height} is over the pixel budget")
+                continue
             base_image = doc.extract_image(xref)
             image_bytes = base_image["image"]
             ext = base_image["ext"]
@@ -228,12 +907,15 @@ def extract_all_images(pdf_path):
             image_paths.append(path)
             
     doc.close()
+    register_artifacts(image_paths, "image")
     return image_paths
 
-def extract_pdf_data(pdf_path, image_paths):
+def extract_pdf_data(pdf_path, image_paths, template, mark=None):
+    mark = mark or (lambda stage: None)
     doc = fitz.open(pdf_path)
     page = doc[0]
     full_text = page.get_text("text")
+    mark("parse")
 
     fin_matches = re.findall(r"\b\d{4}\s\d{4}\s\d{4}\b", full_text)
     fin_number = fin_matches[-1].strip() if fin_matches else None
@@ -251,138 +933,1237 @@ def extract_pdf_data(pdf_path, image_paths):
                 except:
                     pass
 
+    mark("ocr")
     if not fin_number: fin_number = "Hin Argamne"
 
     fan_matches = re.findall(r"\b\d{4}\s\d{4}\s\d{4}\s\d{4}\b", full_text)
     fan_number = fan_matches[0].replace(" ", "") if fan_matches else "Hin Argamne"
 
-    fullname_text = page.get_textbox(fitz.Rect(50, 360, 300, 372)).strip()
-    fullname_fixed = fullname_text.replace("| ", "\n")
+    data = run_extraction_plan(page, full_text, template["layout"]["extraction"])
+    doc.close()
+    return data
+
+def hash_uploaded_file(uploaded_file):
+    """SHA-256 of an uploaded file, read in chunks; the stream is rewound afterwards"""
+    h = hashlib.sha256()
+    stream = uploaded_file.stream
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+        h.update(chunk)
+    stream.seek(0)
+    return h.hexdigest()
+
+def get_cached_extraction(pdf_hash):
+    """(fields, photo bytes) for a PDF seen before, or None"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    c = conn.cursor()
+    c.execute("SELECT fields, photo FROM pdf_cache WHERE pdf_hash = ?", (pdf_hash,))
+    row = c.fetchone()
+    if row:
+        c.execute("UPDATE pdf_cache SET last_used = ? WHERE pdf_hash = ?", (time.time(), pdf_hash))
+        conn.commit()
+    conn.close()
+    if not row:
+        return None
+    return json.loads(row[0]), row[1]
+
+def store_cached_extraction(pdf_hash, data, photo_bytes):
+    size = len(json.dumps(data)) + len(photo_bytes or b"")
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    c = conn.cursor()
+    c.execute("INSERT OR REPLACE INTO pdf_cache (pdf_hash, fields, photo, size, last_used) VALUES (?, ?, ?, ?, ?)",
+              (pdf_hash, json.dumps(data), photo_bytes, size, time.time()))
+    
+    # Evict least recently used entries until both limits hold again
+    c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pdf_cache")
+    entries, total = c.fetchone()
+    if entries > PDF_CACHE_MAX_ENTRIES or total > PDF_CACHE_MAX_BYTES:
+        evict = []
+        c.execute("SELECT pdf_hash, size FROM pdf_cache ORDER BY last_used")
+        for old_hash, old_size in c.fetchall():
+            if entries <= PDF_CACHE_MAX_ENTRIES and total <= PDF_CACHE_MAX_BYTES:
+                break
+            evict.append((old_hash,))
+            entries -= 1
+            total -= old_size
+        c.executemany("DELETE FROM pdf_cache WHERE pdf_hash = ?", evict)
+    conn.commit()
+    conn.close()
+
+def uploaded_file_size(uploaded_file):
+    stream = uploaded_file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def preflight_pdf(pdf_path, template):
+    """Reject uploads that are not a Fayda printout before anything heavy runs.
+
+    Only the document structure and the first page's text are read: page
+    count, number of distinct embedded images, the layout's text signature
+    and text inside the rects of its required fields. No image is extracted
+    or decoded. Raises ValueError saying what is wrong.
+    """
+    try:
+        doc = fitz.open(pdf_path, filetype="pdf")
+    except Exception:
+        raise ValueError("The uploaded file is not a readable PDF")
+    try:
+        if doc.needs_pass:
+            raise ValueError("Password protected PDFs are not supported")
+        if not 1 <= doc.page_count <= PDF_MAX_PAGES:
+            raise ValueError(f"The PDF has {doc.page_count} pages, a Fayda printout has at most {PDF_MAX_PAGES}")
+        images = {img[0] for page in doc for img in page.get_images()}
+        if len(images) > PDF_MAX_IMAGES:
+            raise ValueError(f"The PDF has {len(images)} images, a Fayda printout has at most {PDF_MAX_IMAGES}")
+        
+        # One text extraction of the first page serves every text check
+        layout = template["layout"]
+        page = doc[0]
+        textpage = page.get_textpage()
+        if layout["signature"] and not any(text in page.get_text("text", textpage=textpage)
+                                           for text in layout["signature"]):
+            raise ValueError("This PDF is not a Fayda printout")
+        words = [fitz.Rect(word[:4]) for word in page.get_text("words", textpage=textpage)]
+        missing = [name for name, rect in layout["required_rects"]
+                   if not any(word.intersects(rect) for word in words)]
+        if missing:
+            raise ValueError(f"Fields missing from the PDF: {', '.join(missing)}")
+    finally:
+        doc.close()
+
+def extract_pdf_cached(pdf_file, template, mark=None):
+    """Fields and original photo of an uploaded PDF, parsing it only on a cache miss.
+
+    Fields are extracted with the template's layout, so the cache is keyed
+    by the PDF hash plus the template id and layout version.
+    Returns (data, photo, pdf_hash) where photo is a path or file object that
+    Image.open accepts, or None when the PDF has no image. Raises ValueError
+    for uploads that fail preflight_pdf(). mark(stage) is called after the
+    "upload", "parse" and "ocr" stages (all three at once on a cache hit).
+    """
+    mark = mark or (lambda stage: None)
+    size = uploaded_file_size(pdf_file)
+    if size > PDF_MAX_BYTES:
+        raise ValueError(f"The PDF is too large ({size // 1024} KB, at most {PDF_MAX_BYTES // 1024} KB)")
+    pdf_hash = hash_uploaded_file(pdf_file)
+    cache_key = f"{pdf_hash}:{template['id']}:v{template['layout']['version']}"
+    cached = get_cached_extraction(cache_key)
+    if cached:
+        data, photo_bytes = cached
+        for stage in ("upload", "parse", "ocr"):
+            mark(stage)
+        return data, BytesIO(photo_bytes) if photo_bytes else None, pdf_hash
     
-    dob_text = page.get_textbox(fitz.Rect(50, 430, 300, 435)).strip()
-    sex_text = page.get_textbox(fitz.Rect(50, 500, 300, 510)).strip()
-    nationality_text = page.get_textbox(fitz.Rect(50, 560, 300, 575)).strip()
+    pdf_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4().hex[:5]}.pdf")
+    pdf_file.save(pdf_path)
+    try:
+        preflight_pdf(pdf_path, template)
+    except ValueError:
+        os.remove(pdf_path)
+        raise
+    register_artifacts([pdf_path], "upload")
+    mark("upload")
     
-    region_text = page.get_textbox(fitz.Rect(50, 400, 300, 410)).strip()
-    region_fixed = region_text.replace("| ", "\n")
+    extracted_images = extract_all_images(pdf_path)
+    data = extract_pdf_data(pdf_path, extracted_images, template, mark)
+    photo = extracted_images[0] if extracted_images else None
+    photo_bytes = None
+    if photo:
+        with open(photo, "rb") as f:
+            photo_bytes = f.read()
+    store_cached_extraction(cache_key, data, photo_bytes)
+    return data, photo, pdf_hash
+
+def compile_layout(path):
+    """Read a layout file and compile it into an extraction plan and a render plan.
+
+    Each field in the file may have a "source" on the uploaded PDF (a text
+    "rect", or a "regex" over the page text with an optional "default"),
+    "replace" pairs applied to the extracted text, and its place on the card:
+    "position" and "size" plus either "spacing" or a rotation "angle".
+    Straight fields with a "max_width" and/or "max_height" (card pixels from
+    "position") shrink to fit, down to "min_size". Fields are drawn in file
+    order. An optional "qr" block ("position", square "size" and the "fields"
+    it encodes) is drawn last. "template" and "font" name the bitmap and font
+    file. The "signature" texts (one must be on the first page) and the rects
+    of "required" fields are what preflight_pdf() checks. This runs once when
+    a template is loaded, so requests only walk the compiled tuples.
+    """
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+    if spec.get("version") != LAYOUT_VERSION:
+        raise ValueError(f"{path}: unsupported layout version {spec.get('version')!r}")
     
-    zone_text = page.get_textbox(fitz.Rect(50, 460, 400, 470)).strip()
-    zone_fixed = zone_text.replace("| ", "\n")
+    extraction, required_rects, text_fields, rotated_fields, fit = [], [], [], [], {}
+    for field in spec["fields"]:
+        name = field["name"]
+        source = field.get("source")
+        if source:
+            if "rect" in source:
+                compiled = fitz.Rect(source["rect"])
+            else:
+                compiled = (re.compile(source["regex"]), source.get("default", ""))
+            replace = tuple((old, new) for old, new in field.get("replace", []))
+            extraction.append((name, compiled, replace))
+            if field.get("required") and "rect" in source:
+                required_rects.append((name, compiled))
+        if "angle" in field:
+            rotated_fields.append((name, tuple(field["position"]), field["size"], field["angle"]))
+        else:
+            text_fields.append((name, tuple(field["position"]), field["size"], field.get("spacing", 4)))
+            if "max_width" in field or "max_height" in field:
+                fit[name] = (field.get("max_width"), field.get("max_height"), field.get("min_size", FIT_MIN_SIZE))
     
-    woreda_text = page.get_textbox(fitz.Rect(50, 527, 300, 537)).strip()
-    woreda_fixed = woreda_text.replace("| ", "\n")
+    photos = {name: (tuple(slot["position"]), tuple(slot["size"])) for name, slot in spec["photos"].items()}
+    qr = spec.get("qr")
+    if qr:
+        qr = (tuple(qr["position"]), qr["size"], tuple(qr["fields"]))
+    return {"name": spec["name"], "version": spec["version"], "extraction": extraction,
+            "template": spec.get("template", TEMPLATE_PATH), "font": spec.get("font", FONT_PATH),
+            "signature": tuple(spec.get("signature", ())), "required_rects": required_rects,
+            "photos": photos, "text_fields": text_fields, "rotated_fields": rotated_fields, "fit": fit, "qr": qr,
+            "field_order": [field[0] for field in text_fields + rotated_fields] + (["qr"] if qr else [])}
 
-    data = {
-        "fullname": fullname_fixed,
-        "dob": dob_text,
-        "sex": sex_text,
-        "nationality": nationality_text,
-        "phone": page.get_textbox(fitz.Rect(50, 600, 300, 625)).strip(),
-        "region": region_fixed,
-        "zone": zone_fixed,
-        "woreda": woreda_fixed,
-        "fan": page.get_textbox(fitz.Rect(350, 100, 500, 120)).strip(),
-    }
-    doc.close()
+def run_extraction_plan(page, full_text, plan):
+    """Field values of a PDF page following a compiled extraction plan"""
+    data = {}
+    for name, source, replace in plan:
+        if isinstance(source, fitz.Rect):
+            text = page.get_textbox(source).strip()
+        else:
+            pattern, default = source
+            match = pattern.search(full_text)
+            if not match:
+                data[name] = default
+                continue
+            text = match.group(0).strip()
+        for old, new in replace:
+            text = text.replace(old, new)
+        data[name] = text
     return data
 
-def generate_card(data, image_paths, fin_number):
-    card = Image.open(TEMPLATE_PATH).convert("RGBA")
-    draw = ImageDraw.Draw(card)
+# Card template registry. Layouts are read from LAYOUT_FOLDER at startup;
+# bitmaps, fonts and compiled layouts are loaded on first use
+CARD_TEMPLATES = {os.path.splitext(name)[0]: os.path.join(LAYOUT_FOLDER, name)
+                  for name in sorted(os.listdir(LAYOUT_FOLDER)) if name.endswith(".json")}
+TEMPLATE_STATS = {template_id: {"hits": 0, "misses": 0, "loads": 0} for template_id in CARD_TEMPLATES}
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+_scaled_templates_lock = threading.Lock()
+
+# Fields a user may correct on an existing card
+EDITABLE_FIELDS = ["fin", "fullname", "dob", "sex", "nationality", "region", "zone", "woreda", "phone", "fan"]
+# Longest corrected value, as a card field box holds it: an Amharic and an
+# English line (the two dates of "dob") of at most this many characters
+EDIT_MAX_LINES = 2
+EDIT_MAX_LINE_LENGTH = 60
+
+def load_card_template(template_id):
+    layout = compile_layout(CARD_TEMPLATES[template_id])
+    return {"id": template_id, "layout": layout, "bitmap": Image.open(layout["template"]).convert("RGBA"),
+            "scaled": OrderedDict(), "fonts": {}, "pdf_font": None, "jpeg": None}
 
-    now = datetime.now()
-    gc_issued = now.strftime("%d/%m/%Y")
-    eth_issued_obj = EthiopianDateConverter.to_ethiopian(now.year, now.month, now.day)
-    ec_issued = f"{eth_issued_obj.day:02d}/{eth_issued_obj.month:02d}/{eth_issued_obj.year}"
+def get_template(template_id=None):
+    """Registry entry of a card template: compiled layout, decoded bitmap and fonts.
+
+    Templates are loaded on first use and at most TEMPLATE_CACHE_SIZE stay
+    resident; the least recently used one is dropped to make room (and is
+    simply loaded again when asked for). Raises KeyError for unknown ids.
+    """
+    template_id = template_id or DEFAULT_TEMPLATE_ID
+    if template_id not in CARD_TEMPLATES:
+        raise KeyError(f"Unknown card template: {template_id}")
+    with _templates_lock:
+        template = _templates.get(template_id)
+        if template is not None:
+            _templates.move_to_end(template_id)
+            TEMPLATE_STATS[template_id]["hits"] += 1
+            return template
+        TEMPLATE_STATS[template_id]["misses"] += 1
     
-    gc_expiry = now.replace(year=now.year + 8).strftime("%d/%m/%Y")
-    ec_expiry = f"{eth_issued_obj.day:02d}/{eth_issued_obj.month:02d}/{eth_issued_obj.year + 8}"
-    expiry_full = f"{gc_expiry} | {ec_expiry}"
+    template = load_card_template(template_id)
+    with _templates_lock:
+        if template_id in _templates:
+            # Loaded by another request meanwhile
+            return _templates[template_id]
+        TEMPLATE_STATS[template_id]["loads"] += 1
+        _templates[template_id] = template
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template
 
-    # Original photo
-    if len(image_paths) > 0 and image_paths[0] is not None:
-        try:
-            original_photo = Image.open(image_paths[0]).convert("RGBA")
-            datas = original_photo.getdata()
-            newData = []
-            for item in datas:
-                if item[0] > 220 and item[1] > 220 and item[2] > 220:
-                    newData.append((255, 255, 255, 0))
-                else:
-                    newData.append(item)
-            original_photo.putdata(newData)
-            
-            p_large = original_photo.resize((310, 400))
-            card.paste(p_large, (65, 200), p_large)
-            
-            p_small = original_photo.resize((100, 135))
-            card.paste(p_small, (800, 450), p_small)
-        except Exception as e:
-            print(f"Error processing original photo: {e}")
+def requested_template_id(value):
+    """Template id picked in a form, falling back to the default for unknown ids"""
+    return value if value in CARD_TEMPLATES else DEFAULT_TEMPLATE_ID
 
-    # New photo
-    if len(image_paths) > 1 and image_paths[1] is not None:
+def get_font(template, size):
+    font = template["fonts"].get(size)
+    if font is None:
         try:
-            new_photo = Image.open(image_paths[1]).convert("RGBA")
-            datas = new_photo.getdata()
-            newData = []
-            for item in datas:
-                if item[0] > 220 and item[1] > 220 and item[2] > 220:
-                    newData.append((255, 255, 255, 0))
-                else:
-                    newData.append(item)
-            new_photo.putdata(newData)
-            
-            new_resized = new_photo.resize((530, 550))
-            card.paste(new_resized, (1550, 30), new_resized)
-        except Exception as e:
-            print(f"Error processing new photo: {e}")
+            font = ImageFont.truetype(template["layout"]["font"], size)
+        except:
+            font = ImageFont.load_default()
+        template["fonts"][size] = font
+    return font
 
-    # FIN number
+def get_card_template(template, scale=1.0):
+    """Decoded (and scaled) template bitmap; callers must copy() before drawing.
+
+    Scaled bitmaps are kept in an LRU of TEMPLATE_SCALES_PER_TEMPLATE per template.
+    """
+    if scale == 1.0:
+        return template["bitmap"]
+    scaled = template["scaled"]
+    with _scaled_templates_lock:
+        bitmap = scaled.get(scale)
+        if bitmap is not None:
+            scaled.move_to_end(scale)
+            return bitmap
+    bitmap = template["bitmap"]
+    size = (round(bitmap.width * scale), round(bitmap.height * scale))
+    factor = int(1 / scale)
+    if factor > 1:
+        bitmap = bitmap.reduce(factor)
+    bitmap = bitmap.resize(size, Image.LANCZOS)
+    with _scaled_templates_lock:
+        scaled[scale] = bitmap
+        while len(scaled) > TEMPLATE_SCALES_PER_TEMPLATE:
+            scaled.popitem(last=False)
+    return bitmap
+
+def _ethiopian_new_year(year):
+    return ETHIOPIAN_EPOCH + 365 * (year - 1) + year // 4
+
+def _ordinal_to_ethiopian(ordinal):
+    """(year, month, day) of Gregorian day ordinals; works on ints and NumPy arrays.
+
+    Every year has 12 months of 30 days and Pagume (month 13) of 5 days,
+    6 in years before a Gregorian leap year (year % 4 == 3).
+    """
+    year = (4 * (ordinal - ETHIOPIAN_EPOCH) + 1463) // 1461
+    day_of_year = ordinal - _ethiopian_new_year(year)
+    return year, day_of_year // 30 + 1, day_of_year % 30 + 1
+
+def _build_ethiopian_table():
+    first, last = (day.toordinal() for day in ETHIOPIAN_TABLE_RANGE)
+    years, months, days = _ordinal_to_ethiopian(np.arange(first, last + 1))
+    return first, np.stack([years, months, days], axis=1).astype(np.int16)
+
+_ethiopian_first, _ethiopian_table = _build_ethiopian_table()
+
+def to_ethiopian(day):
+    """Ethiopian (year, month, day) of a Gregorian date"""
+    index = day.toordinal() - _ethiopian_first
+    if 0 <= index < len(_ethiopian_table):
+        year, month, eth_day = _ethiopian_table[index].tolist()
+        return year, month, eth_day
+    return _ordinal_to_ethiopian(day.toordinal())
+
+def to_ethiopian_batch(days):
+    """Ethiopian dates of many Gregorian dates (dates or datetime64[D]) as an (n, 3) array"""
+    ordinals = np.asarray(days, dtype="datetime64[D]").astype(np.int64) + date(1970, 1, 1).toordinal()
+    index = ordinals - _ethiopian_first
+    if len(index) and index.min() >= 0 and index.max() < len(_ethiopian_table):
+        return _ethiopian_table[index]
+    return np.stack(_ordinal_to_ethiopian(ordinals), axis=-1)
+
+def to_gregorian(year, month, day):
+    """Gregorian date of an Ethiopian date; raises ValueError for days that do not exist"""
+    pagume = 6 if year % 4 == 3 else 5
+    if not 1 <= month <= 13 or not 1 <= day <= (pagume if month == 13 else 30):
+        raise ValueError(f"{day:02d}/{month:02d}/{year} is not an Ethiopian calendar date")
+    return date.fromordinal(_ethiopian_new_year(year) + 30 * (month - 1) + day - 1)
+
+def add_years(day, years):
+    """Same day `years` later; Feb 29 becomes Feb 28 when the target year has none"""
     try:
-        fin_font = ImageFont.truetype(FONT_PATH, 25)
-    except:
-        fin_font = ImageFont.load_default()
+        return day.replace(year=day.year + years)
+    except ValueError:
+        return day.replace(year=day.year + years, day=28)
+
+@lru_cache(maxsize=8)
+def card_date_values(day):
+    """Issue and expiry texts of cards issued on a (Gregorian) day.
+
+    The Ethiopian expiry is the same Ethiopian day CARD_VALIDITY_YEARS later;
+    that keeps year % 4, so Pagume 6 stays a valid day.
+    """
+    eth_year, eth_month, eth_day = to_ethiopian(day)
+    gc_expiry = add_years(day, CARD_VALIDITY_YEARS).strftime("%d/%m/%Y")
+    ec_expiry = f"{eth_day:02d}/{eth_month:02d}/{eth_year + CARD_VALIDITY_YEARS}"
+    return {
+        "expiry": f"{gc_expiry} | {ec_expiry}",
+        "gc_issued": day.strftime("%d/%m/%Y"),
+        "ec_issued": f"{eth_day:02d}/{eth_month:02d}/{eth_year}",
+    }
+
+def card_field_values(data, fin_number):
+    """Every text drawn on the card, keyed by its layout field name"""
+    values = dict(data)
+    values.update(card_date_values(date.today()))
+    values.update({
+        "fin": fin_number,
+        "serial": f" {random.randint(10000000, 99999999)}",
+    })
+    return values
+
+def rotated_text_sprite(text, angle, font, color):
+    text_bbox = font.getbbox(text)
+    txt_img = Image.new("RGBA", (text_bbox[2], text_bbox[3] + 10), (255, 255, 255, 0))
+    d = ImageDraw.Draw(txt_img)
+    d.text((0, 0), text, fill=color, font=font)
+    return txt_img.rotate(angle, expand=True)
+
+TEXT_SPRITE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+_text_sprites = OrderedDict()
+_text_sprites_lock = threading.Lock()
+_measure = ImageDraw.Draw(Image.new("L", (1, 1)))
+
+def text_sprite(text, font, spacing=0, angle=0, color="black"):
+    """Rasterized text as (source, mask, offset, bytes), from an LRU shared by all cards.
+
+    canvas.paste(source, (x + offset[0], y + offset[1]), mask) draws exactly
+    what ImageDraw.text at (x, y) (angle 0) or draw_rotated_text() would.
+    Straight text is a coverage mask pasted in the fill color; rotated text
+    keeps the RGBA sprite of rotated_text_sprite().
+    """
+    key = (getattr(font, "path", None), getattr(font, "size", None), text, spacing, angle, color)
+    with _text_sprites_lock:
+        sprite = _text_sprites.get(key)
+        if sprite is not None:
+            _text_sprites.move_to_end(key)
+            TEXT_SPRITE_STATS["hits"] += 1
+            return sprite
+    
+    if angle:
+        rotated = rotated_text_sprite(text, angle, font, color)
+        sprite = (rotated, rotated, (0, 0))
+        size = rotated.width * rotated.height * 4
+    else:
+        x0, y0, x1, y1 = _measure.textbbox((0, 0), text, font=font, spacing=spacing)
+        mask = Image.new("L", (x1 - x0, y1 - y0))
+        ImageDraw.Draw(mask).text((-x0, -y0), text, fill=255, font=font, spacing=spacing)
+        sprite = (color, mask, (x0, y0))
+        size = mask.width * mask.height
     
-    draw.text((1265, 545), fin_number, fill="black", font=fin_font)
+    with _text_sprites_lock:
+        TEXT_SPRITE_STATS["misses"] += 1
+        if size > TEXT_SPRITE_MAX_BYTES:
+            return sprite + (size,)
+        if key not in _text_sprites:
+            _text_sprites[key] = sprite + (size,)
+            TEXT_SPRITE_STATS["bytes"] += size
+        while TEXT_SPRITE_STATS["bytes"] > TEXT_SPRITE_CACHE_BYTES:
+            TEXT_SPRITE_STATS["bytes"] -= _text_sprites.popitem(last=False)[1][3]
+            TEXT_SPRITE_STATS["evictions"] += 1
+    return sprite + (size,)
 
-    # Other text
+def draw_text_sprite(canvas, text, position, font, spacing=0, angle=0, color="black"):
+    """Draw text through the sprite cache; returns the box it covers"""
+    source, mask, (dx, dy), _ = text_sprite(text, font, spacing, angle, color)
+    box = (position[0] + dx, position[1] + dy, position[0] + dx + mask.width, position[1] + dy + mask.height)
+    if mask.width and mask.height:
+        canvas.paste(source, box, mask)
+    return box
+
+def draw_rotated_text(canvas, text, position, angle, font, color):
+    return draw_text_sprite(canvas, text, position, font, angle=angle, color=color)
+
+@lru_cache(maxsize=64)
+def _measure_font(font_path, size):
     try:
-        font = ImageFont.truetype(FONT_PATH, 37)
-        small_multiline = ImageFont.truetype(FONT_PATH, 28)
-        small = ImageFont.truetype(FONT_PATH, 32)
-        iss_font = ImageFont.truetype(FONT_PATH, 25)
-        sn_font = ImageFont.truetype(FONT_PATH, 26) 
+        return ImageFont.truetype(font_path, size)
     except:
-        font = small = iss_font = sn_font = ImageFont.load_default()
-
-    draw.text((405, 170), data["fullname"], fill="black", font=font, spacing=8)
-    draw.text((405, 305), data["dob"], fill="black", font=small)
-    draw.text((405, 375), data["sex"], fill="black", font=small)
-    draw.text((1130, 165), data["nationality"], fill="black", font=small)
-    draw.text((1130, 235), data["region"], fill="black", font=small_multiline, spacing=5)
-    draw.text((1130, 315), data["zone"], fill="black", font=small_multiline, spacing=5)
-    draw.text((1130, 390), data["woreda"], fill="black", font=small_multiline, spacing=5)
-    draw.text((1130, 65), data["phone"], fill="black", font=small)
-    draw.text((470, 500), data["fan"], fill="black", font=small)
-    draw.text((405, 440), expiry_full, fill="black", font=small)
-    draw.text((1930, 595), f" {random.randint(10000000, 99999999)}", fill="black", font=sn_font)
-
-    def draw_rotated_text(canvas, text, position, angle, font, color):
-        text_bbox = font.getbbox(text)
-        txt_img = Image.new("RGBA", (text_bbox[2], text_bbox[3] + 10), (255, 255, 255, 0))
-        d = ImageDraw.Draw(txt_img)
-        d.text((0, 0), text, fill=color, font=font)
-        rotated = txt_img.rotate(angle, expand=True)
-        canvas.paste(rotated, position, rotated)
-
-    draw_rotated_text(card, gc_issued, (13, 120), 90, iss_font, "black")
-    draw_rotated_text(card, ec_issued, (13, 390), 90, iss_font, "black")
+        return ImageFont.load_default()
+
+@lru_cache(maxsize=TEXT_EXTENT_CACHE_SIZE)
+def text_extent(font_path, size, text, spacing):
+    """Width and height text drawn at (0, 0) reaches, memoized per string and size"""
+    box = _measure.textbbox((0, 0), text, font=_measure_font(font_path, size), spacing=spacing)
+    return box[2], box[3]
+
+def field_font_size(template, field, text, size, spacing):
+    """The field's layout size, or the largest smaller one its text fits at.
+
+    Sizes are searched at print resolution (binary search over measured
+    extents), so previews shrink a field exactly like the full card does.
+    Extents grow almost linearly with the size, so the search starts from
+    the size the overflow predicts and usually ends one measurement later.
+    """
+    fit = template["layout"]["fit"].get(field)
+    if not fit:
+        return size
+    max_width, max_height, min_size = fit
+    font_path = template["layout"]["font"]
+    
+    def fits(candidate):
+        width, height = text_extent(font_path, candidate, text, spacing)
+        return (not max_width or width <= max_width) and (not max_height or height <= max_height)
+    
+    if fits(size):
+        return size
+    width, height = text_extent(font_path, size, text, spacing)
+    ratio = min(max_width / width if max_width else 1, max_height / height if max_height else 1)
+    guess = min(size - 1, max(min_size, int(size * ratio)))
+    if fits(guess):
+        if guess + 1 == size or not fits(guess + 1):
+            return guess
+        low, high = guess + 1, size - 1
+    else:
+        low, high = min_size, guess - 1
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def qr_payload(values, fields):
+    """Text of a card's QR block, e.g. "FIN:123456789012 FAN:5874102406892370 SN:12345678".
+
+    Upper case, digits, ":" and spaces keep the code in alphanumeric mode,
+    the densest one that can hold these values.
+    """
+    names = {"serial": "SN"}
+    return " ".join(f"{names.get(field, field.upper())}:{values[field].strip()}" for field in fields)
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_image(payload, size):
+    """QR code of payload as a size x size grayscale image, light margin included.
+
+    The module matrix goes straight into a NumPy array and each module is
+    repeated to a whole number of pixels; nothing is drawn module by module.
+    """
+    matrix = np.array(segno.make(payload, error="m", micro=False, mask=QR_MASK).matrix, dtype=bool)
+    modules = np.pad(matrix, QR_QUIET_ZONE)
+    scale = max(1, size // modules.shape[0])
+    pixels = np.where(modules.repeat(scale, axis=0).repeat(scale, axis=1), 0, 255).astype(np.uint8)
+    code = Image.fromarray(pixels)
+    if code.width > size:
+        return code.resize((size, size), Image.NEAREST)
+    image = Image.new("L", (size, size), 255)
+    offset = (size - code.width) // 2
+    image.paste(code, (offset, offset))
+    return image
+
+def _scaler(scale):
+    def sc(value):
+        return tuple(max(1, round(v * scale)) for v in value) if isinstance(value, tuple) else max(1, round(value * scale))
+    return sc
+
+def field_box(job, field):
+    """Bounding box the field's current text covers on the card"""
+    sc = _scaler(job["scale"])
+    template = job["template"]
+    text = job["values"].get(field)
+    for name, position, size, spacing in template["layout"]["text_fields"]:
+        if name == field:
+            size = field_font_size(template, field, text, size, spacing)
+            return _measure.textbbox(sc(position), text, font=get_font(template, sc(size)), spacing=sc(spacing))
+    for name, position, size, angle in template["layout"]["rotated_fields"]:
+        if name == field:
+            _, rotated, _, _ = text_sprite(text, get_font(template, sc(size)), angle=angle)
+            x, y = sc(position)
+            return (x, y, x + rotated.width, y + rotated.height)
+    qr = template["layout"]["qr"]
+    if field == "qr" and qr:
+        x, y = sc(qr[0])
+        return (x, y, x + sc(qr[1]), y + sc(qr[1]))
+    raise KeyError(field)
+
+def draw_field(job, field):
+    sc = _scaler(job["scale"])
+    template = job["template"]
+    text = job["values"].get(field)
+    for name, position, size, spacing in template["layout"]["text_fields"]:
+        if name == field:
+            size = field_font_size(template, field, text, size, spacing)
+            job["boxes"][field] = draw_text_sprite(job["card"], text, sc(position), get_font(template, sc(size)),
+                                                   sc(spacing))
+            return
+    for name, position, size, angle in template["layout"]["rotated_fields"]:
+        if name == field:
+            job["boxes"][field] = draw_rotated_text(job["card"], text, sc(position), angle,
+                                                    get_font(template, sc(size)), "black")
+            return
+    qr = template["layout"]["qr"]
+    if field == "qr" and qr:
+        job["card"].paste(qr_image(qr_payload(job["values"], qr[2]), sc(qr[1])), sc(qr[0]))
+        job["boxes"][field] = field_box(job, field)
+
+def render_card_photos(template, image_paths, scale=1.0):
+    """Card photos by photo slot name, decoded at slot size with backgrounds removed"""
+    sc = _scaler(scale)
+    slots = template["layout"]["photos"]
+    photos = {}
+    for index, slot in ((0, "original"), (1, "new")):
+        if len(image_paths) > index and image_paths[index] is not None:
+            try:
+                photos[slot] = load_photo(image_paths[index], sc(slots[slot][1]))
+            except Exception as e:
+                print(f"Error processing photo {index}: {e}")
+    try:
+        photos = dict(zip(photos, remove_backgrounds(list(photos.values()))))
+    except Exception as e:
+        print(f"Error removing photo backgrounds with {BG_ENGINE}: {e}")
+        photos = dict(zip(photos, threshold_engine(list(photos.values()))))
+    if "original" in photos:
+        # The small copy is derived from the already downscaled large one
+        photos["original_small"] = photos["original"].resize(sc(slots["original_small"][1]))
+    return photos
+
+def render_card_layers(data, image_paths, fin_number, scale=1.0, template_id=None, mark=None):
+    """Draw the card layout at `scale` (1.0 = print resolution).
 
+    Returns the job's layer stack: "base" (template + photos), "card" (base +
+    all text) and the text value and bounding box of every field, which is
+    what update_card_fields() needs to redraw single fields later.
+    mark(stage) is called once the "photo" and "composite" stages are done.
+    """
+    mark = mark or (lambda stage: None)
+    sc = _scaler(scale)
+    template = get_template(template_id)
+    base = get_card_template(template, scale).copy()
+    for slot, photo in render_card_photos(template, image_paths, scale).items():
+        base.paste(photo, sc(template["layout"]["photos"][slot][0]), photo)
+    mark("photo")
+
+    job = {"scale": scale, "template": template, "base": base, "card": base.copy(), "boxes": {},
+           "values": card_field_values(data, fin_number)}
+    for field in template["layout"]["field_order"]:
+        draw_field(job, field)
+    mark("composite")
+    return job
+
+def render_card(data, image_paths, fin_number, scale=1.0, template_id=None):
+    """Draw the card layout at `scale` (1.0 = print resolution) and return the image"""
+    return render_card_layers(data, image_paths, fin_number, scale, template_id)["card"]
+
+def _overlaps(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def update_card_fields(job, changes):
+    """Apply changed field values to a rendered job, redrawing only dirty rectangles.
+
+    Every field whose box touches an old or new box of a changed field is
+    redrawn as well, onto freshly restored base pixels and in layout order, so
+    the result is identical to a full render with the new values.
+    """
+    changes = {field: text for field, text in changes.items() if job["values"].get(field) != text}
+    if not changes:
+        return []
+    qr = job["template"]["layout"]["qr"]
+    if qr and not changes.keys().isdisjoint(qr[2]):
+        changes["qr"] = qr_payload(dict(job["values"], **changes), qr[2])
+    field_order = job["template"]["layout"]["field_order"]
+    old_boxes = dict(job["boxes"])
+    job["values"].update(changes)
+    new_boxes = {field: field_box(job, field) for field in changes}
+    
+    dirty = set(changes)
+    rects = [old_boxes[field] for field in dirty] + list(new_boxes.values())
+    while True:
+        more = {field for field in field_order
+                if field not in dirty and any(_overlaps(old_boxes[field], rect) for rect in rects)}
+        if not more:
+            break
+        dirty |= more
+        rects += [old_boxes[field] for field in more]
+    
+    for rect in rects:
+        job["card"].paste(job["base"].crop(rect), rect[:2])
+    for field in field_order:
+        if field in dirty:
+            draw_field(job, field)
+    return rects
+
+_card_jobs = OrderedDict()
+_card_jobs_lock = threading.Lock()
+
+def remember_card_job(card_path, job):
+    with _card_jobs_lock:
+        _card_jobs[os.path.basename(card_path)] = job
+        _card_jobs.move_to_end(os.path.basename(card_path))
+        while len(_card_jobs) > CARD_JOB_CACHE_SIZE:
+            _card_jobs.popitem(last=False)
+
+def pop_card_job(filename):
+    with _card_jobs_lock:
+        return _card_jobs.pop(filename, None)
+
+def save_card(card):
     out_path = os.path.join(CARD_FOLDER, f"id_{uuid.uuid4().hex[:6]}.png")
     card.convert("RGB").save(out_path)
+    save_card_thumbnail(card, out_path)
+    register_artifacts([out_path], "card")
     return out_path
 
+def get_card_template_jpeg(template):
+    """Template bitmap encoded once as JPEG, which PyMuPDF embeds without re-encoding"""
+    if template["jpeg"] is None:
+        buffer = BytesIO()
+        template["bitmap"].convert("RGB").save(buffer, "JPEG", quality=92)
+        template["jpeg"] = buffer.getvalue()
+    return template["jpeg"]
+
+def get_card_pdf_font(template):
+    if template["pdf_font"] is None:
+        template["pdf_font"] = fitz.Font(fontfile=template["layout"]["font"])
+    return template["pdf_font"]
+
+def _pdf_text_lines(template, text, position, size, spacing):
+    """Baseline origin and width (in card pixels) of every line PIL draws for a field.
+
+    PIL places the top of the first line's ascender at `position` and steps
+    lines by the height of "A" plus the spacing; PDF text is positioned by
+    its baseline, so the ascent is added.
+    """
+    font = get_font(template, size)
+    ascent = font.getmetrics()[0]
+    line_height = font.getbbox("A")[3] + spacing
+    for i, line in enumerate(text.split("\n")):
+        yield line, (position[0], position[1] + ascent + i * line_height), font.getlength(line)
+
+def _pdf_insert_text(page, template, origin, text, size, width, rotate=0):
+    """Insert card text at `origin` (card pixels), stretched to the raster line width.
+
+    PIL advances glyphs by hinted, whole pixel widths, so its lines run a
+    few percent longer than the font's own metrics; matching the width
+    keeps PDF and PNG cards laid out identically.
+    """
+    k = CARD_PT_PER_PX
+    point = fitz.Point(origin[0] * k, origin[1] * k)
+    natural = get_card_pdf_font(template).text_length(text, fontsize=size)
+    morph = None
+    if natural and width:
+        stretch = width / natural
+        morph = (point, fitz.Matrix(1, stretch) if rotate else fitz.Matrix(stretch, 1))
+    page.insert_text(point, text, fontsize=size * k, fontname=CARD_PDF_FONT, rotate=rotate, morph=morph)
+
+def render_card_pdf(data, image_paths, fin_number, template_id=None, mark=None):
+    """Build the card as a one page vector PDF from the same layout as the PNG.
+
+    The template and the photos are embedded as images and every field is
+    real text in the embedded (subsetted) card font. Returns the PDF bytes.
+    """
+    mark = mark or (lambda stage: None)
+    k = CARD_PT_PER_PX
+    template = get_template(template_id)
+    layout = template["layout"]
+    values = card_field_values(data, fin_number)
+    
+    doc = fitz.open()
+    page = doc.new_page(width=template["bitmap"].width * k, height=template["bitmap"].height * k)
+    page.insert_image(page.rect, stream=get_card_template_jpeg(template))
+    
+    for slot, photo in render_card_photos(template, image_paths).items():
+        (x, y), (w, h) = layout["photos"][slot]
+        buffer = BytesIO()
+        photo.save(buffer, "PNG")
+        page.insert_image(fitz.Rect(x * k, y * k, (x + w) * k, (y + h) * k), stream=buffer.getvalue(),
+                          keep_proportion=False)
+    mark("photo")
+    
+    page.insert_font(fontname=CARD_PDF_FONT, fontfile=layout["font"])
+    for field, position, size, spacing in layout["text_fields"]:
+        size = field_font_size(template, field, values[field], size, spacing)
+        for line, origin, width in _pdf_text_lines(template, values[field], position, size, spacing):
+            _pdf_insert_text(page, template, origin, line, size, width)
+    for field, position, size, angle in layout["rotated_fields"]:
+        # Rotated fields run bottom to top (90 degrees), starting where the
+        # raster sprite's left edge ends up after rotation
+        font = get_font(template, size)
+        text = values[field]
+        origin = (position[0] + font.getmetrics()[0], position[1] + font.getbbox(text)[2])
+        _pdf_insert_text(page, template, origin, text, size, font.getlength(text), rotate=angle)
+    if layout["qr"]:
+        (x, y), size, fields = layout["qr"]
+        buffer = BytesIO()
+        qr_image(qr_payload(values, fields), size * QR_PDF_OVERSAMPLE).save(buffer, "PNG")
+        page.insert_image(fitz.Rect(x * k, y * k, (x + size) * k, (y + size) * k), stream=buffer.getvalue())
+    mark("composite")
+    
+    doc.subset_fonts()
+    pdf_bytes = doc.tobytes(garbage=3, deflate=True)
+    doc.close()
+    return pdf_bytes
+
+def save_card_pdf(pdf_bytes):
+    out_path = os.path.join(CARD_FOLDER, f"id_{uuid.uuid4().hex[:6]}.pdf")
+    with open(out_path, "wb") as f:
+        f.write(pdf_bytes)
+    save_card_thumbnail(rasterize_card_pdf(out_path, THUMB_WIDTH * 2), out_path)
+    register_artifacts([out_path], "card")
+    return out_path
+
+def rasterize_card_pdf(path, width):
+    """First page of a card PDF as an image `width` pixels wide"""
+    with fitz.open(path) as doc:
+        page = doc[0]
+        zoom = width / page.rect.width
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+def generate_card(data, image_paths, fin_number, output="png", template_id=None, mark=None):
+    """Render the card and save it as a PNG (default) or vector PDF; returns the path.
+
+    mark(stage) is called after the "photo", "composite" and "encode" stages.
+    """
+    mark = mark or (lambda stage: None)
+    if output == "pdf":
+        out_path = save_card_pdf(render_card_pdf(data, image_paths, fin_number, template_id, mark))
+    else:
+        job = render_card_layers(data, image_paths, fin_number, template_id=template_id, mark=mark)
+        out_path = save_card(job["card"])
+        remember_card_job(out_path, job)
+    mark("encode")
+    return out_path
+
+def render_card_preview(data, image_paths, fin_number, scale=PREVIEW_SCALE, template_id=None):
+    """Small JPEG of the card layout, for checking it before the full render"""
+    card = render_card(data, image_paths, fin_number, scale=scale, template_id=template_id)
+    buffer = BytesIO()
+    card.convert("RGB").save(buffer, "JPEG", quality=75)
+    return buffer.getvalue()
+
+PIPELINE_STAGES = ("upload", "parse", "ocr", "photo", "composite", "encode", "record")
+
+def run_card_pipeline(user_id, pdf_file, photo_file, fin_number, output="png", template_id=None, on_stage=None,
+                      idempotency=None):
+    """Extract, render and record one card for a user; shared by /generate and the API.
+
+    on_stage(stage, ms) is called as each of PIPELINE_STAGES finishes.
+    Returns the extracted fields, the new card's id and path, and the time
+    each stage took in milliseconds. Raises ValueError when the uploaded
+    photo cannot be used.
+    idempotency=(key, fingerprint) stores the result under the key in the
+    same transaction as the card; if another worker stored that key first,
+    this card is not recorded and the stored result is returned instead.
+    """
+    timings = {}
+    started = time.perf_counter()
+    
+    def finish(stage):
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = round((now - started) * 1000, 1)
+        started = now
+        if on_stage:
+            on_stage(stage, timings[stage])
+    
+    template_id = requested_template_id(template_id)
+    if output not in CARD_OUTPUT_FORMATS:
+        output = "png"
+    
+    data, original_photo, _ = extract_pdf_cached(pdf_file, get_template(template_id), finish)
+    
+    # Saving the uploaded photo counts towards the "photo" stage, which ends
+    # once both photos are cut out and placed on the card
+    user_photo_path = None
+    if photo_file and photo_file.filename:
+        user_photo_path = save_user_uploaded_image(photo_file)
+        if not user_photo_path:
+            raise ValueError("Suura Ashaaraa Crop Ta'e Qofa save godhuu keessatti dogoggora ta'e")
+    
+    final_image_paths = prepare_images_for_card([original_photo] if original_photo else [], user_photo_path)
+    card_path = generate_card(data, final_image_paths, fin_number, output, template_id, finish)
+    
+    # Record the card generation
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("INSERT INTO cards_generated (user_id, card_path, content_hash) VALUES (?, ?, ?)",
+             (user_id, card_path, file_content_hash(card_path)))
+    card_id = c.lastrowid
+    
+    # Update free cards count
+    c.execute("UPDATE users SET free_cards_generated = free_cards_generated + 1 WHERE id = ?", (user_id,))
+    
+    # Record in free transactions
+    c.execute("INSERT INTO free_transactions (user_id) VALUES (?)", (user_id,))
+    
+    result = {"data": data, "card_id": card_id, "card_path": card_path, "output": output,
+              "template": template_id, "timings": timings}
+    if idempotency:
+        key, fingerprint = idempotency
+        try:
+            c.execute("INSERT INTO idempotency_keys (user_id, key, fingerprint, result, expires_at) "
+                      "VALUES (?, ?, ?, ?, ?)",
+                      (user_id, key, fingerprint, json.dumps(result), time.time() + IDEMPOTENCY_TTL))
+        except sqlite3.IntegrityError:
+            # The card file is left to the janitor like any other expired card
+            conn.rollback()
+            conn.close()
+            return replay_card_result(user_id, key, fingerprint)
+    
+    conn.commit()
+    conn.close()
+    finish("record")
+    return result
+
+def idempotency_key_from_request():
+    """The request's Idempotency-Key header or idempotency_key field, or None.
+
+    Raises ValueError for a key that is not 8-128 printable ASCII characters.
+    """
+    key = request.headers.get("Idempotency-Key") or request.values.get("idempotency_key")
+    if not key:
+        return None
+    if not re.fullmatch(IDEMPOTENCY_KEY_PATTERN, key):
+        raise ValueError("The idempotency key must be 8 to 128 printable ASCII characters without spaces")
+    return key
+
+def card_request_fingerprint(pdf_file, photo_file, fin_number, output, template_id):
+    """Hash of everything that decides which card a request makes"""
+    photo_hash = hash_uploaded_file(photo_file) if photo_file and photo_file.filename else ""
+    output = output if output in CARD_OUTPUT_FORMATS else "png"
+    parts = (hash_uploaded_file(pdf_file), photo_hash, fin_number, output, requested_template_id(template_id))
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()
+
+def replay_card_result(user_id, key, fingerprint):
+    """Stored result of an earlier request with this key, or None.
+
+    Raises ValueError when the key was used for a different card request.
+    """
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT fingerprint, result FROM idempotency_keys WHERE user_id = ? AND key = ? AND expires_at > ?",
+              (user_id, key, time.time()))
+    row = c.fetchone()
+    if row is None:
+        # An expired row would make the new result's insert fail
+        c.execute("DELETE FROM idempotency_keys WHERE user_id = ? AND key = ?", (user_id, key))
+        conn.commit()
+    conn.close()
+    if row is None:
+        return None
+    if row[0] != fingerprint:
+        raise ValueError("This idempotency key was already used for a different card")
+    return dict(json.loads(row[1]), replayed=True)
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def run_card_pipeline_once(user_id, idempotency_key, pdf_file, photo_file, fin_number, output="png",
+                           template_id=None, on_stage=None):
+    """run_card_pipeline() at most once per user and idempotency key.
+
+    Concurrent requests with the same key wait for the one already running
+    in this worker and share its result or error (single-flight); later
+    ones get the stored result. Replayed results have "replayed": True.
+    Without a key every call runs the pipeline.
+    """
+    if not idempotency_key:
+        return run_card_pipeline(user_id, pdf_file, photo_file, fin_number, output, template_id, on_stage)
+    
+    fingerprint = card_request_fingerprint(pdf_file, photo_file, fin_number, output, template_id)
+    with _inflight_lock:
+        flight = _inflight.get((user_id, idempotency_key))
+        leader = flight is None
+        if leader:
+            flight = {"fingerprint": fingerprint, "done": threading.Event(), "result": None, "error": None}
+            _inflight[(user_id, idempotency_key)] = flight
+    
+    if not leader:
+        flight["done"].wait()
+        if flight["fingerprint"] != fingerprint:
+            raise ValueError("This idempotency key was already used for a different card")
+        if flight["error"]:
+            raise flight["error"]
+        return dict(flight["result"], replayed=True)
+    
+    try:
+        result = replay_card_result(user_id, idempotency_key, fingerprint)
+        if result is None:
+            result = run_card_pipeline(user_id, pdf_file, photo_file, fin_number, output, template_id, on_stage,
+                                       (idempotency_key, fingerprint))
+        flight["result"] = result
+        return result
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[(user_id, idempotency_key)]
+        flight["done"].set()
+
+_progress = {}
+_progress_cond = threading.Condition()
+
+def progress_start(job_id, user_id):
+    """Open the event list of a generation; other users can not follow it"""
+    now = time.time()
+    with _progress_cond:
+        for key in [key for key, entry in _progress.items() if now - entry["updated"] > PROGRESS_TTL]:
+            del _progress[key]
+        entry = _progress.get(job_id)
+        if entry and entry["user_id"] != user_id:
+            return False
+        _progress[job_id] = {"user_id": user_id, "events": [], "updated": now}
+        _progress_cond.notify_all()
+    return True
+
+def progress_publish(job_id, stage, **fields):
+    with _progress_cond:
+        entry = _progress.get(job_id)
+        if entry is None:
+            return
+        entry["events"].append(dict(fields, stage=stage))
+        entry["updated"] = time.time()
+        _progress_cond.notify_all()
+
+def progress_events(job_id, user_id):
+    """Server-sent events for a running generation, ending with its "done" or "error" event.
+
+    A job that progress_start() has not opened yet, that has already finished
+    or that belongs to another user gets a single "unknown" event right away,
+    so a stream never waits for (or holds a worker ahead of) the upload; the
+    page opens it again until the upload is being processed. Keepalive
+    comments are sent while a stage is running.
+    """
+    with _progress_cond:
+        entry = _progress.get(job_id)
+        finished = entry is not None and entry["events"] and entry["events"][-1]["stage"] in ("done", "error")
+        if entry is None or entry["user_id"] != user_id or finished:
+            entry = None
+    if entry is None:
+        yield "event: unknown\ndata: {}\n\n"
+        return
+    
+    sent = 0
+    deadline = time.time() + PROGRESS_TIMEOUT
+    while time.time() < deadline:
+        with _progress_cond:
+            woken = len(entry["events"]) > sent or _progress_cond.wait(PROGRESS_KEEPALIVE)
+            if _progress.get(job_id) is not entry:
+                # Expired, or started again by a new upload
+                yield "event: unknown\ndata: {}\n\n"
+                return
+            events = entry["events"][sent:]
+        if not events:
+            if not woken:
+                yield ": keepalive\n\n"
+            continue
+        for event in events:
+            sent += 1
+            yield f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+            if event["stage"] in ("done", "error"):
+                return
+
+def impose_cards(card_paths, out_path, layout="a4"):
+    """Lay cards out on print sheets and write them to a PDF at out_path.
+
+    Each card image is embedded once and placed by xref afterwards; PDF cards
+    are placed as vector pages with show_pdf_page(), clipped to the side. Every
+    SHEET_FLUSH_PAGES pages the document is written out (first a full save,
+    then incremental saves) and reopened, so only the pages still being
+    built are held in memory however many cards there are.
+    Returns the number of pages written.
+    """
+    spec = SHEET_LAYOUTS[layout]
+    page_w, page_h = spec["page"]
+    pt_per_px = CARD_PT_PER_PX
+    
+    if spec["sides"]:
+        cell_w, cell_h = page_w, page_h
+        margin_x = margin_y = gap = 0
+    else:
+        cell_w = CARD_BACK_BOX[2] * pt_per_px
+        cell_h = CARD_BACK_BOX[3] * pt_per_px
+        gap = 12
+        margin_x = (page_w - spec["columns"] * cell_w - (spec["columns"] - 1) * gap) / 2
+        margin_y = (page_h - spec["rows"] * cell_h - (spec["rows"] - 1) * gap) / 2
+    per_page = spec["columns"] * spec["rows"]
+    
+    def placements():
+        for path in card_paths:
+            if spec["sides"]:
+                for box in (CARD_FRONT_BOX, CARD_BACK_BOX):
+                    yield path, box
+            else:
+                yield path, None
+    
+    doc = fitz.open()
+    xrefs = {}
+    src = src_path = None
+    page = None
+    pages = slot = unsaved = 0
+    saved = False
+    
+    def flush():
+        nonlocal doc, saved, unsaved
+        if saved:
+            doc.save(out_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, deflate=True)
+        else:
+            doc.save(out_path, garbage=0, deflate=True)
+            saved = True
+        doc.close()
+        doc = fitz.open(out_path)
+        unsaved = 0
+    
+    for path, box in placements():
+        if page is None or slot == per_page:
+            if unsaved >= SHEET_FLUSH_PAGES:
+                flush()
+            page = doc.new_page(width=page_w, height=page_h)
+            pages += 1
+            unsaved += 1
+            slot = 0
+        
+        col, row = slot % spec["columns"], slot // spec["columns"]
+        x = margin_x + col * (cell_w + gap)
+        y = margin_y + row * (cell_h + gap)
+        if path.endswith(".pdf"):
+            # Both sides come from the same card, so only the last one is kept open
+            if path != src_path:
+                if src:
+                    src.close()
+                src, src_path = fitz.open(path), path
+            clip = fitz.Rect(box) * pt_per_px if box else None
+            page.show_pdf_page(fitz.Rect(x, y, x + cell_w, y + cell_h), src, 0, clip=clip, keep_proportion=False)
+            slot += 1
+            continue
+        if box:
+            # Place the whole image so that only this side falls on the page
+            scale = cell_w / (box[2] - box[0])
+            with Image.open(path) as card:
+                width, height = card.size
+            rect = fitz.Rect(x - box[0] * scale, y - box[1] * scale,
+                             x + (width - box[0]) * scale, y + (height - box[1]) * scale)
+        else:
+            rect = fitz.Rect(x, y, x + cell_w, y + cell_h)
+        
+        if path in xrefs:
+            page.insert_image(rect, xref=xrefs[path], keep_proportion=False)
+        else:
+            xrefs[path] = page.insert_image(rect, filename=path, keep_proportion=False)
+        slot += 1
+    
+    if src:
+        src.close()
+    if page is None:
+        doc.new_page(width=page_w, height=page_h)
+    if unsaved or not saved:
+        flush()
+    doc.close()
+    return pages
+
+def user_cards(user_id, date_from=None, date_to=None):
+    """(card_path, created_at) of a user's cards that still exist, oldest first"""
+    query = "SELECT card_path, created_at FROM cards_generated WHERE user_id = ? AND expired = 0"
+    params = [user_id]
+    if date_from:
+        query += " AND created_at >= ?"
+        params.append(date_from)
+    if date_to:
+        query += " AND created_at < date(?, '+1 day')"
+        params.append(date_to)
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute(query + " ORDER BY id", params)
+    rows = c.fetchall()
+    conn.close()
+    return [(path, created_at) for path, created_at in rows if os.path.exists(path)]
+
+def user_card_paths(user_id, date_from=None, date_to=None):
+    """Paths of a user's PNG and PDF cards, oldest first"""
+    return [path for path, _ in user_cards(user_id, date_from, date_to) if path.endswith((".png", ".pdf"))]
+
+class _ZipSink:
+    """Write-only, unseekable file for ZipFile that hands out what was written so far.
+
+    ZipFile falls back to data descriptors on unseekable files, so entries
+    never need to be rewritten and the archive can be sent as it is built.
+    """
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def stream_zip(entries):
+    """Yield a ZIP archive of (archive name, file path) entries chunk by chunk.
+
+    Neither the archive nor a whole member is ever held in memory: each file
+    is copied in ZIP_CHUNK_SIZE pieces and every piece is yielded as soon as
+    ZipFile has written it. Already compressed formats are stored.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w") as archive:
+        for arcname, path in entries:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            stored = path.lower().endswith(ZIP_STORED_EXTENSIONS)
+            info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+            with open(path, "rb") as src, archive.open(info, "w") as dest:
+                for chunk in iter(lambda: src.read(ZIP_CHUNK_SIZE), b""):
+                    dest.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+@app.cli.command("create-api-token")
+@click.argument("username")
+@click.option("--name", default="", help="What the token is for")
+def create_api_token_command(username, name):
+    """Create a JSON API token for a user; it is shown only once."""
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT id FROM users WHERE username = ?", (username,))
+    user = c.fetchone()
+    if not user:
+        conn.close()
+        raise click.ClickException(f"No user named {username}")
+    token = secrets.token_urlsafe(32)
+    c.execute("INSERT INTO api_tokens (user_id, token_hash, name) VALUES (?, ?, ?)",
+              (user[0], hashlib.sha256(token.encode()).hexdigest(), name))
+    conn.commit()
+    conn.close()
+    click.echo(token)
+
+@app.cli.command("impose-cards")
+@click.argument("card_files", nargs=-1)
+@click.option("--user-id", type=int, help="Use all cards generated by this user")
+@click.option("--layout", type=click.Choice(sorted(SHEET_LAYOUTS)), default="a4", show_default=True)
+@click.option("--output", "-o", default="cards_sheet.pdf", show_default=True)
+def impose_cards_command(card_files, user_id, layout, output):
+    """Impose generated cards onto print sheets (PDF)."""
+    if not card_files and user_id is None:
+        raise click.UsageError("Give card files or --user-id")
+    paths = list(card_files)
+    if user_id is not None:
+        paths += user_card_paths(user_id)
+    if not paths:
+        raise click.ClickException("No card files found")
+    pages = impose_cards(paths, output, layout)
+    click.echo(f"{len(paths)} cards -> {pages} pages -> {output}")
+
+@app.cli.command("ethiopian-dates")
+@click.argument("dates", nargs=-1, required=True)
+@click.option("--to-gregorian", "reverse", is_flag=True, help="Convert Ethiopian DD/MM/YYYY dates instead")
+def ethiopian_dates_command(dates, reverse):
+    """Convert Gregorian YYYY-MM-DD dates to Ethiopian (or back)."""
+    try:
+        if reverse:
+            for text in dates:
+                day, month, year = (int(part) for part in text.split("/"))
+                click.echo(f"{text}  {to_gregorian(year, month, day).isoformat()}")
+            return
+        converted = to_ethiopian_batch([date.fromisoformat(text) for text in dates])
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    for text, (year, month, day) in zip(dates, converted.tolist()):
+        click.echo(f"{text}  {day:02d}/{month:02d}/{year}")
+
 # 6. ROUTES - FREE VERSION
 @app.route('/')
 def home():
@@ -419,64 +2200,7 @@ def signup():
         finally:
             conn.close()
     
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Sign Up - FREE ID Card Service</title>
-        <style>
-            body { font-family: Arial; max-width: 400px; margin: 50px auto; padding: 20px; background: #f0f7ff; }
-            .form-group { margin-bottom: 15px; }
-            label { display: block; margin-bottom: 5px; }
-            input { width: 100%; padding: 10px; box-sizing: border-box; border: 1px solid #ddd; border-radius: 5px; }
-            button { background: #27ae60; color: white; padding: 12px 20px; border: none; border-radius: 5px; cursor: pointer; width: 100%; font-size: 16px; }
-            .error { color: red; background: #ffebee; padding: 10px; border-radius: 5px; margin-bottom: 10px; }
-            .success { color: green; background: #e8f5e9; padding: 10px; border-radius: 5px; margin-bottom: 10px; }
-            .free-banner { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 15px; border-radius: 10px; text-align: center; margin-bottom: 20px; }
-            .free-banner h2 { margin: 0; }
-        </style>
-    </head>
-    <body>
-        <div class="free-banner">
-            <h2>🎉 FREE ID CARD SERVICE</h2>
-            <p>No payment required - Generate unlimited ID cards!</p>
-        </div>
-        
-        <h2>Sign Up</h2>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="{{ category }}">{{ message }}</div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        <form method="POST">
-            <div class="form-group">
-                <label>Username:</label>
-                <input type="text" name="username" required>
-            </div>
-            <div class="form-group">
-                <label>Email:</label>
-                <input type="email" name="email" required>
-            </div>
-            <div class="form-group">
-                <label>Password:</label>
-                <input type="password" name="password" required>
-            </div>
-            <div class="form-group">
-                <label>Confirm Password:</label>
-                <input type="password" name="confirm_password" required>
-            </div>
-            <div class="form-group">
-                <label>Phone (optional):</label>
-                <input type="text" name="phone">
-            </div>
-            <button type="submit">Sign Up</button>
-        </form>
-        <p style="text-align: center; margin-top: 20px;">Already have an account? <a href="/login">Login</a></p>
-    </body>
-    </html>
-    ''')
+    return render_template('signup.html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -499,55 +2223,7 @@ def login():
             flash('Invalid username or password!', 'error')
             return redirect(url_for('login'))
     
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Login - FREE ID Card Service</title>
-        <style>
-            body { font-family: Arial; max-width: 400px; margin: 50px auto; padding: 20px; background: #f0f7ff; }
-            .form-group { margin-bottom: 15px; }
-            label { display: block; margin-bottom: 5px; }
-            input { width: 100%; padding: 10px; box-sizing: border-box; border: 1px solid #ddd; border-radius: 5px; }
-            button { background: #3498db; color: white; padding: 12px 20px; border: none; border-radius: 5px; cursor: pointer; width: 100%; font-size: 16px; }
-            .error { color: red; background: #ffebee; padding: 10px; border-radius: 5px; margin-bottom: 10px; }
-            .success { color: green; background: #e8f5e9; padding: 10px; border-radius: 5px; margin-bottom: 10px; }
-            .free-banner { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 15px; border-radius: 10px; text-align: center; margin-bottom: 20px; }
-            .free-banner h2 { margin: 0; }
-        </style>
-    </head>
-    <body>
-        <div class="free-banner">
-            <h2>🎉 FREE ID CARD SERVICE</h2>
-            <p>Generate ID cards without any payment!</p>
-        </div>
-        
-        <h2>Login</h2>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="{{ category }}">{{ message }}</div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        <form method="POST">
-            <div class="form-group">
-                <label>Username:</label>
-                <input type="text" name="username" required>
-            </div>
-            <div class="form-group">
-                <label>Password:</label>
-                <input type="password" name="password" required>
-            </div>
-            <button type="submit">Login</button>
-        </form>
-        <p style="text-align: center; margin-top: 20px;">
-            Don't have an account? <a href="/signup">Sign Up</a><br>
-            <a href="/forgot-password">Forgot Password?</a>
-        </p>
-    </body>
-    </html>
-    ''')
+    return render_template('login.html')
 
 @app.route('/dashboard')
 @login_required
@@ -564,131 +2240,22 @@ def dashboard():
     total_cards = c.fetchone()[0]
     
     # Get recent card generations
-    c.execute('''SELECT card_path, created_at FROM cards_generated 
+    c.execute('''SELECT card_path, created_at, expired FROM cards_generated 
                  WHERE user_id = ? ORDER BY created_at DESC LIMIT 5''',
               (session['user_id'],))
     recent_cards = c.fetchall()
     
     conn.close()
     
-    # Create recent cards HTML
-    recent_cards_html = ""
-    if recent_cards:
-        for card in recent_cards:
-            filename = os.path.basename(card[0])
-            recent_cards_html += f'''
-                <tr>
-                    <td>{filename}</td>
-                    <td>{card[1]}</td>
-                    <td><a href="/download-card/{filename}" target="_blank">Download</a></td>
-                </tr>
-            '''
-    else:
-        recent_cards_html = '<tr><td colspan="3">No cards generated yet</td></tr>'
-    
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Dashboard - FREE ID Card Service</title>
-        <style>
-            body { font-family: Arial; max-width: 1200px; margin: 0 auto; padding: 20px; background: #f9f9f9; }
-            .header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 30px; }
-            .user-info { background: white; padding: 20px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); margin-bottom: 20px; }
-            .free-banner { background: linear-gradient(135deg, #27ae60 0%, #2ecc71 100%); color: white; padding: 20px; border-radius: 10px; margin-bottom: 20px; text-align: center; }
-            .stats { display: flex; justify-content: space-between; margin: 20px 0; }
-            .stat-card { flex: 1; padding: 20px; background: white; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); margin: 0 10px; text-align: center; }
-            .stat-value { font-size: 32px; font-weight: bold; color: #27ae60; }
-            .stat-label { color: #666; margin-top: 10px; }
-            .btn { padding: 12px 24px; color: white; text-decoration: none; border-radius: 5px; display: inline-block; margin: 5px; }
-            .btn-primary { background: #3498db; }
-            .btn-success { background: #27ae60; }
-            .btn-warning { background: #f39c12; }
-            .recent-cards { background: white; padding: 20px; border-radius: 10px; box-shadow: 0 2px 10px rgba(0,0,0,0.1); margin-top: 20px; }
-            table { width: 100%; border-collapse: collapse; margin-top: 10px; }
-            th, td { padding: 12px; text-align: left; border-bottom: 1px solid #ddd; }
-            th { background: #f8f9fa; }
-        </style>
-    </head>
-    <body>
-        <div class="free-banner">
-            <h1>🎉 FREE ID CARD GENERATION SERVICE</h1>
-            <p>Generate unlimited ID cards without any payment!</p>
-        </div>
-        
-        <div class="header">
-            <h2>Welcome, {{ username }}!</h2>
-            <div>
-                <a href="/generate" class="btn btn-success">Generate New ID Card</a>
-                <a href="/logout" class="btn btn-warning">Logout</a>
-            </div>
-        </div>
-        
-        <div class="stats">
-            <div class="stat-card">
-                <div class="stat-value">{{ total_cards }}</div>
-                <div class="stat-label">Total Cards Generated</div>
-            </div>
-            <div class="stat-card">
-                <div class="stat-value">FREE</div>
-                <div class="stat-label">Service Type</div>
-            </div>
-            <div class="stat-card">
-                <div class="stat-value">Unlimited</div>
-                <div class="stat-label">Cards Remaining</div>
-            </div>
-        </div>
-        
-        <div class="user-info">
-            <h3>Account Information</h3>
-            <p><strong>Email:</strong> {{ email }}</p>
-            <p><strong>Phone:</strong> {{ phone or 'Not provided' }}</p>
-            <p><strong>Account Created:</strong> Free Service User</p>
-        </div>
-        
-        <div style="text-align: center; margin: 30px 0;">
-            <a href="/generate" class="btn btn-success" style="font-size: 18px; padding: 15px 30px;">
-                🚀 Generate FREE ID Card Now
-            </a>
-        </div>
-        
-        <div class="recent-cards">
-            <h3>Recent Cards Generated</h3>
-            {% if total_cards > 0 %}
-            <table>
-                <tr>
-                    <th>File Name</th>
-                    <th>Generated Date</th>
-                    <th>Action</th>
-                </tr>
-                {{ recent_cards_html|safe }}
-            </table>
-            {% else %}
-            <p style="text-align: center; color: #666; padding: 20px;">
-                No cards generated yet. Click the button above to generate your first FREE ID card!
-            </p>
-            {% endif %}
-        </div>
-        
-        <div style="background: #e8f4f8; padding: 20px; border-radius: 10px; margin-top: 30px;">
-            <h3>📝 How to Generate FREE ID Cards:</h3>
-            <ol>
-                <li>Click "Generate New ID Card" button</li>
-                <li>Upload your PDF file (from government system)</li>
-                <li>Upload your cropped photo (white background removed)</li>
-                <li>Enter your 12-digit FIN number</li>
-                <li>Click "Generate ID Card" - It's FREE!</li>
-                <li>Download your generated ID card</li>
-            </ol>
-            <p><strong>Note:</strong> This is a FREE service. No payment is required at any stage.</p>
-        </div>
-    </body>
-    </html>
-    ''', username=user[0], email=user[1], phone=user[2], 
-       total_cards=total_cards, recent_cards_html=recent_cards_html)
+    recent_cards = [{"filename": os.path.basename(card[0]), "created_at": card[1], "expired": card[2]}
+                    for card in recent_cards]
+    
+    return render_template('dashboard.html', username=user[0], email=user[1], phone=user[2],
+                           total_cards=total_cards, recent_cards=recent_cards)
 
 @app.route('/generate', methods=['GET', 'POST'])
 @login_required
+@rate_limited
 def generate():
     if request.method == 'POST':
         # FREE SERVICE - No payment check needed
@@ -724,178 +2291,256 @@ def generate():
             </div>
             ''', 400
         
-        pdf_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4().hex[:5]}.pdf")
-        pdf.save(pdf_path)
+        # Stage events for the page's progress stream, when it sent a job id
+        job_id = request.form.get("job_id", "")
+        on_stage = None
+        if re.fullmatch(r"[A-Za-z0-9-]{8,64}", job_id) and progress_start(job_id, session['user_id']):
+            total = len(PIPELINE_STAGES)
+            on_stage = lambda stage, ms: progress_publish(job_id, stage, ms=ms,
+                                                          step=PIPELINE_STAGES.index(stage) + 1, total=total)
+        else:
+            job_id = None
         
         try:
-            extracted_images = extract_all_images(pdf_path)
-            data = extract_pdf_data(pdf_path, extracted_images)
-            user_photo_path = save_user_uploaded_image(user_photo)
-            
-            if not user_photo_path:
-                return "Suura Ashaaraa Crop Ta'e Qofa save godhuu keessatti dogoggora ta'e", 400
-            
-            final_image_paths = prepare_images_for_card(extracted_images, user_photo_path)
-            card_path = generate_card(data, final_image_paths, fin_number)
-            
-            # Record the card generation
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("INSERT INTO cards_generated (user_id, card_path) VALUES (?, ?)",
-                     (session['user_id'], card_path))
-            
-            # Update free cards count
-            c.execute("UPDATE users SET free_cards_generated = free_cards_generated + 1 WHERE id = ?",
-                     (session['user_id'],))
-            
-            # Record in free transactions
-            c.execute("INSERT INTO free_transactions (user_id) VALUES (?)",
-                     (session['user_id'],))
-            
-            conn.commit()
-            conn.close()
-            
-            return send_file(card_path, mimetype='image/png', as_attachment=True, download_name="Fayda_Card.png")
+            result = run_card_pipeline_once(session['user_id'], idempotency_key_from_request(), pdf, user_photo,
+                                            fin_number, request.form.get('output', 'png'),
+                                            request.form.get('template'), on_stage)
+            if job_id:
+                progress_publish(job_id, "done", ms=round(sum(result["timings"].values()), 1))
+            return send_file(result["card_path"], mimetype=card_mimetype(result["card_path"]), as_attachment=True,
+                             download_name=f"Fayda_Card.{result['output']}")
             
+        except ValueError as e:
+            if job_id:
+                progress_publish(job_id, "error", message=str(e))
+            return str(e), 400
         except Exception as e:
+            if job_id:
+                progress_publish(job_id, "error", message="Card generation failed")
             return f"Error: {str(e)}", 500
     
     # GET request - show form
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Generate FREE ID Card</title>
-        <style>
-            body { font-family: Arial; max-width: 800px; margin: 0 auto; padding: 20px; background: #f0f7ff; }
-            .form-container { background: white; padding: 30px; border-radius: 15px; box-shadow: 0 4px 20px rgba(0,0,0,0.1); }
-            .form-group { margin-bottom: 25px; padding: 20px; background: #f8f9fa; border-radius: 10px; }
-            label { display: block; margin-bottom: 10px; font-weight: bold; font-size: 16px; }
-            input { width: 100%; padding: 12px; box-sizing: border-box; border: 2px solid #ddd; border-radius: 8px; font-size: 16px; }
-            input:focus { border-color: #3498db; outline: none; }
-            button { background: linear-gradient(135deg, #27ae60 0%, #2ecc71 100%); color: white; padding: 15px 40px; border: none; border-radius: 8px; cursor: pointer; width: 100%; font-size: 18px; font-weight: bold; }
-            button:hover { background: linear-gradient(135deg, #219653 0%, #27ae60 100%); }
-            .free-badge { background: #e74c3c; color: white; padding: 5px 15px; border-radius: 20px; font-size: 14px; font-weight: bold; display: inline-block; margin-left: 10px; }
-            .note { background: #e8f4f8; padding: 20px; border-radius: 10px; margin-top: 30px; }
-            .step-guide { background: #fff3cd; padding: 20px; border-radius: 10px; margin-bottom: 30px; }
-            .step { display: flex; align-items: center; margin-bottom: 15px; }
-            .step-number { background: #3498db; color: white; width: 30px; height: 30px; border-radius: 50%; display: flex; align-items: center; justify-content: center; margin-right: 15px; }
-        </style>
-    </head>
-    <body>
-        <div style="text-align: center; margin-bottom: 30px;">
-            <h1 style="color: #27ae60;">🎉 Generate FREE ID Card</h1>
-            <p style="font-size: 18px; color: #666;">No payment required - Completely FREE service!</p>
-        </div>
-        
-        <div class="step-guide">
-            <h3>📋 Step-by-Step Guide:</h3>
-            <div class="step">
-                <div class="step-number">1</div>
-                <div>Upload PDF file from government system</div>
-            </div>
-            <div class="step">
-                <div class="step-number">2</div>
-                <div>Upload cropped photo (white background removed)</div>
-            </div>
-            <div class="step">
-                <div class="step-number">3</div>
-                <div>Enter your 12-digit FIN number</div>
-            </div>
-            <div class="step">
-                <div class="step-number">4</div>
-                <div>Click "Generate FREE ID Card" button</div>
-            </div>
-        </div>
-        
-        <div class="form-container">
-            <form method="POST" enctype="multipart/form-data" onsubmit="return validateForm()">
-                <div class="form-group">
-                    <label for="pdf">PDF Fayilaa (Mandatory) <span class="free-badge">FREE</span></label>
-                    <input type="file" name="pdf" id="pdf" accept=".pdf" required>
-                    <small style="color: #666;">PDF file from government system containing your information</small>
-                </div>
-                
-                <div class="form-group">
-                    <label for="photo">Suura Ashaaraa Crop Ta'e Qofa (Mandatory) <span class="free-badge">FREE</span></label>
-                    <input type="file" name="photo" id="photo" accept="image/*" required>
-                    <small style="color: #666;">Suuraa ashaaraa crop ta'e qofa filadhu (background white ta'ee dhiisu)</small>
-                </div>
-                
-                <div class="form-group">
-                    <label for="fin_number">FIN Lakkoofsaa (Mandatory) <span class="free-badge">FREE</span></label>
-                    <input type="text" name="fin_number" id="fin_number" 
-                           pattern="\\d{12}" 
-                           title="Digitii 12 qofa galchuu qabda" 
-                           placeholder="123456789012" maxlength="12" required>
-                    <div id="fin_error" style="color: red; display: none; margin-top: 10px; padding: 10px; background: #ffebee; border-radius: 5px;">
-                        FIN Lakkoofsaan dijiitii 12 qofa ta'uu qaba!
-                    </div>
-                </div>
-                
-                <button type="submit">
-                    🚀 Generate FREE ID Card
-                </button>
-            </form>
-        </div>
-        
-        <div class="note">
-            <h3>📝 Important Information:</h3>
-            <p>✅ <strong>FREE SERVICE:</strong> No payment required at any stage</p>
-            <p>✅ <strong>UNLIMITED CARDS:</strong> Generate as many ID cards as you need</p>
-            <p>✅ <strong>INSTANT GENERATION:</strong> Get your ID card immediately</p>
-            <p>✅ <strong>NO TRANSACTION ID:</strong> No need for payment verification</p>
-            <p>✅ <strong>SECURE:</strong> Your data is processed securely</p>
-            <br>
-            <p><strong>Note:</strong> This service extracts information from government PDF files and generates ID cards in the standard format.</p>
-        </div>
-        
-        <div style="text-align: center; margin-top: 30px;">
-            <a href="/dashboard" style="color: #3498db; text-decoration: none; font-size: 16px;">
-                ← Back to Dashboard
-            </a>
-        </div>
-        
-        <script>
-            function validateForm() {
-                const finInput = document.getElementById('fin_number');
-                const finError = document.getElementById('fin_error');
-                
-                if (finInput.value.length !== 12 || !/^\\d+$/.test(finInput.value)) {
-                    finError.style.display = 'block';
-                    finInput.focus();
-                    return false;
-                } else {
-                    finError.style.display = 'none';
-                }
-                return true;
-            }
-            
-            // Real-time validation
-            document.getElementById('fin_number').addEventListener('input', function(e) {
-                const finError = document.getElementById('fin_error');
-                if (this.value.length !== 12 || !/^\\d+$/.test(this.value)) {
-                    finError.style.display = 'block';
-                } else {
-                    finError.style.display = 'none';
-                }
-            });
-        </script>
-    </body>
-    </html>
-    ''')
+    return render_template('generate.html', templates=sorted(CARD_TEMPLATES), default_template=DEFAULT_TEMPLATE_ID,
+                           idempotency_key=secrets.token_urlsafe(16))
+
+@app.route('/generate/progress/<job_id>')
+@login_required
+def generate_progress(job_id):
+    """Server-sent stage events of the /generate request submitted with this job id"""
+    response = app.response_class(progress_events(job_id, session['user_id']), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # let nginx pass events through unbuffered
+    return response
+
+@app.route('/preview-fields', methods=['POST'])
+@login_required
+@rate_limited
+def preview_fields():
+    """Extracted fields of an uploaded PDF, so they can be checked before rendering"""
+    pdf = request.files.get("pdf")
+    if not pdf or pdf.filename == '':
+        return jsonify({"error": "PDF Fayilaa filachuun barbaachisaadha!"}), 400
+    try:
+        template = get_template(requested_template_id(request.form.get("template")))
+        data, _, pdf_hash = extract_pdf_cached(pdf, template)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"pdf_hash": pdf_hash, "fields": data})
+
+@app.route('/generate/preview', methods=['POST'])
+@login_required
+@rate_limited
+def generate_preview():
+    """Inline low resolution render of the card; nothing is saved or recorded"""
+    pdf = request.files.get("pdf")
+    user_photo = request.files.get("photo")
+    fin_number = request.form.get("fin_number", "")
+    if not pdf or pdf.filename == '':
+        return "PDF Fayilaa filachuun barbaachisaadha!", 400
+    
+    try:
+        scale = float(request.args.get("scale", PREVIEW_SCALE))
+    except ValueError:
+        scale = PREVIEW_SCALE
+    scale = min(PREVIEW_SCALES, key=lambda step: abs(step - scale))
+    
+    try:
+        template_id = requested_template_id(request.form.get("template"))
+        data, original_photo, _ = extract_pdf_cached(pdf, get_template(template_id))
+        new_photo = user_photo.stream if user_photo and user_photo.filename else None
+        if new_photo and PHOTO_AUTO_CROP:
+            # The same crop /generate makes, decoded no larger than the preview needs
+            slot = get_template(template_id)["layout"]["photos"]["new"][1]
+            new_photo = open_cropped_photo(new_photo, hash_uploaded_file(user_photo),
+                                           (math.ceil(slot[0] * scale), math.ceil(slot[1] * scale)))
+        image = render_card_preview(data, [original_photo, new_photo], fin_number, scale=scale,
+                                    template_id=template_id)
+    except ValueError as e:
+        return str(e), 400
+    except Exception as e:
+        return f"Error: {str(e)}", 500
+    
+    response = app.response_class(image, mimetype='image/jpeg')
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/cards/<filename>/edit', methods=['POST'])
+@login_required
+@rate_limited
+def edit_card(filename):
+    """Correct fields of a card generated by this worker, redrawing only what changed.
+
+    Accepts form fields or a JSON object named after EDITABLE_FIELDS and
+    returns the corrected card, saved as a new file.
+    """
+    card_path = os.path.join(CARD_FOLDER, filename)
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT id FROM cards_generated WHERE card_path = ? AND user_id = ?", (card_path, session['user_id']))
+    owned = c.fetchone()
+    conn.close()
+    if not owned:
+        return "Card not found", 404
+    
+    changes = request.get_json(silent=True) or request.form
+    changes = {field: str(changes[field]).replace("| ", "\n") for field in EDITABLE_FIELDS if field in changes}
+    if "fin" in changes and (not changes["fin"].isdigit() or len(changes["fin"]) != 12):
+        return "FIN Lakkoofsaan dijiitii 12 qofa ta'uu qaba!", 400
+    for field, value in changes.items():
+        lines = value.split("\n")
+        if len(lines) > EDIT_MAX_LINES or max(len(line) for line in lines) > EDIT_MAX_LINE_LENGTH:
+            return (f"{field} is too long: at most {EDIT_MAX_LINES} lines of "
+                    f"{EDIT_MAX_LINE_LENGTH} characters"), 400
+    
+    job = pop_card_job(filename)
+    if job is None:
+        return "This card can no longer be edited, please generate it again", 409
+    
+    try:
+        update_card_fields(job, changes)
+        new_path = save_card(job["card"])
+    except Exception as e:
+        # Keep the card editable: a failed edit must not cost the next one its job
+        remember_card_job(filename, job)
+        return f"Error: {str(e)}", 500
+    remember_card_job(new_path, job)
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("INSERT INTO cards_generated (user_id, card_path, content_hash) VALUES (?, ?, ?)",
+              (session['user_id'], new_path, file_content_hash(new_path)))
+    conn.commit()
+    conn.close()
+    
+    return send_file(new_path, mimetype='image/png', as_attachment=True, download_name="Fayda_Card.png")
+
+@app.route('/templates/stats')
+@login_required
+def template_stats():
+    """Card template registry: which templates are loaded and their cache hits and misses"""
+    with _templates_lock:
+        loaded = list(_templates)
+    return jsonify({
+        "default": DEFAULT_TEMPLATE_ID,
+        "cache_size": TEMPLATE_CACHE_SIZE,
+        "loaded": loaded,
+        "templates": {template_id: dict(TEMPLATE_STATS[template_id], loaded=template_id in loaded)
+                      for template_id in CARD_TEMPLATES},
+        "text_sprites": dict(TEXT_SPRITE_STATS, entries=len(_text_sprites), max_bytes=TEXT_SPRITE_CACHE_BYTES),
+    })
+
+@app.route('/download-all')
+@login_required
+def download_all():
+    """All of the user's cards as one streamed ZIP (?from=YYYY-MM-DD&to=YYYY-MM-DD)"""
+    cards = user_cards(session['user_id'], request.args.get("from"), request.args.get("to"))
+    if not cards:
+        flash('No cards to download!', 'error')
+        return redirect(url_for('dashboard'))
+    
+    entries = [(f"{created_at[:10]}_{os.path.basename(path)}", path) for path, created_at in cards]
+    response = app.response_class(stream_zip(entries), mimetype='application/zip')
+    response.headers['Content-Disposition'] = 'attachment; filename="Fayda_Cards.zip"'
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/cards/sheet.pdf')
+@login_required
+def cards_sheet():
+    """Print-ready PDF of the user's cards (?layout=a4|cr80&from=YYYY-MM-DD&to=YYYY-MM-DD)"""
+    layout = request.args.get("layout", "a4")
+    if layout not in SHEET_LAYOUTS:
+        return f"Unknown layout, use one of: {', '.join(SHEET_LAYOUTS)}", 400
+    paths = user_card_paths(session['user_id'], request.args.get("from"), request.args.get("to"))
+    if not paths:
+        flash('No cards to print!', 'error')
+        return redirect(url_for('dashboard'))
+    
+    out_path = os.path.join(UPLOAD_FOLDER, f"sheet_{uuid.uuid4().hex[:6]}.pdf")
+    impose_cards(paths, out_path, layout)
+    register_artifacts([out_path], "upload")
+    return send_file(out_path, mimetype='application/pdf', as_attachment=True,
+                     download_name=f"Fayda_Cards_{layout.upper()}.pdf")
 
 @app.route('/download-card/<filename>')
 @login_required
 def download_card(filename):
     """Download a previously generated card"""
     card_path = os.path.join(CARD_FOLDER, filename)
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT content_hash FROM cards_generated WHERE card_path = ? AND user_id = ? LIMIT 1",
+              (card_path, session['user_id']))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        flash('Card not found!', 'error')
+        return redirect(url_for('dashboard'))
+    
+    # Cards are immutable: a revalidation with the stored hash never touches the disk
+    etag = row[0]
+    if etag and request.if_none_match.contains(etag):
+        return send_immutable_file(card_path, card_mimetype(card_path), etag)
+    
     if os.path.exists(card_path):
-        return send_file(card_path, mimetype='image/png', as_attachment=True, download_name=filename)
+        return send_immutable_file(card_path, card_mimetype(card_path), etag or file_content_hash(card_path),
+                                   download_name=filename, as_attachment=True)
     else:
         flash('Card not found!', 'error')
         return redirect(url_for('dashboard'))
 
+@app.route('/card-thumb/<filename>')
+@login_required
+def card_thumbnail(filename):
+    """Small preview of a generated card, created on first request for older cards"""
+    card_path = os.path.join(CARD_FOLDER, filename)
+    thumb_path = thumbnail_path_for(card_path)
+    
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT content_hash FROM cards_generated WHERE card_path = ? AND user_id = ? LIMIT 1",
+              (card_path, session['user_id']))
+    row = c.fetchone()
+    conn.close()
+    if not row:
+        return "Card not found", 404
+    
+    etag = f"{row[0]}-t{THUMB_WIDTH}" if row[0] else None
+    if etag and request.if_none_match.contains(etag):
+        return send_immutable_file(thumb_path, THUMB_MIMETYPE, etag)
+    
+    if not os.path.exists(thumb_path):
+        if not os.path.exists(card_path):
+            return "Card not found", 404
+        if card_path.endswith(".pdf"):
+            save_card_thumbnail(rasterize_card_pdf(card_path, THUMB_WIDTH * 2), card_path)
+        else:
+            with Image.open(card_path) as card:
+                save_card_thumbnail(card, card_path)
+    return send_immutable_file(thumb_path, THUMB_MIMETYPE, etag or file_content_hash(thumb_path))
+
 @app.route('/forgot-password', methods=['GET', 'POST'])
 def forgot_password():
     if request.method == 'POST':
@@ -919,39 +2564,7 @@ def forgot_password():
         
         return redirect(url_for('forgot_password'))
     
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Forgot Password</title>
-        <style>
-            body { font-family: Arial; max-width: 400px; margin: 50px auto; padding: 20px; }
-            .form-group { margin-bottom: 15px; }
-            label { display: block; margin-bottom: 5px; }
-            input { width: 100%; padding: 10px; box-sizing: border-box; }
-            button { background: #f39c12; color: white; padding: 12px 20px; border: none; border-radius: 5px; cursor: pointer; width: 100%; }
-        </style>
-    </head>
-    <body>
-        <h2>Forgot Password</h2>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="{{ category }}">{{ message }}</div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        <form method="POST">
-            <div class="form-group">
-                <label>Email:</label>
-                <input type="email" name="email" required>
-            </div>
-            <button type="submit">Send Reset Link</button>
-        </form>
-        <p><a href="/login">Back to Login</a></p>
-    </body>
-    </html>
-    ''')
+    return render_template('forgot_password.html')
 
 @app.route('/reset-password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
@@ -988,42 +2601,7 @@ def reset_password(token):
         return redirect(url_for('login'))
     
     conn.close()
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Reset Password</title>
-        <style>
-            body { font-family: Arial; max-width: 400px; margin: 50px auto; padding: 20px; }
-            .form-group { margin-bottom: 15px; }
-            label { display: block; margin-bottom: 5px; }
-            input { width: 100%; padding: 10px; box-sizing: border-box; }
-            button { background: #27ae60; color: white; padding: 12px 20px; border: none; border-radius: 5px; cursor: pointer; width: 100%; }
-        </style>
-    </head>
-    <body>
-        <h2>Reset Password</h2>
-        {% with messages = get_flashed_messages(with_categories=true) %}
-            {% if messages %}
-                {% for category, message in messages %}
-                    <div class="{{ category }}">{{ message }}</div>
-                {% endfor %}
-            {% endif %}
-        {% endwith %}
-        <form method="POST">
-            <div class="form-group">
-                <label>New Password:</label>
-                <input type="password" name="password" required>
-            </div>
-            <div class="form-group">
-                <label>Confirm New Password:</label>
-                <input type="password" name="confirm_password" required>
-            </div>
-            <button type="submit">Reset Password</button>
-        </form>
-    </body>
-    </html>
-    ''')
+    return render_template('reset_password.html')
 
 @app.route('/logout')
 def logout():
@@ -1031,10 +2609,137 @@ def logout():
     flash('Logged out successfully!', 'success')
     return redirect(url_for('login'))
 
-if __name__ == "__main__":
-    # Clear old files on startup
-    clear_old_files()
+# 7. JSON API v1
+def spool_request_body():
+    """Copy the raw request body into a file object, on disk once it is large.
+
+    Multipart uploads are already spooled by Werkzeug; this does the same
+    for bodies sent as is, which request.get_data() would read into memory.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY, dir=UPLOAD_FOLDER)
+    shutil.copyfileobj(request.stream, spool, 64 * 1024)
+    spool.seek(0)
+    return spool
+
+def api_token_required(f):
+    """Authenticate with "Authorization: Bearer <token>"; sets g.api_user_id"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth = request.headers.get("Authorization", "")
+        token = auth[len("Bearer "):].strip() if auth.startswith("Bearer ") else ""
+        user = None
+        if token:
+            conn = sqlite3.connect(DB_PATH)
+            c = conn.cursor()
+            c.execute("SELECT id, user_id FROM api_tokens WHERE token_hash = ?",
+                      (hashlib.sha256(token.encode()).hexdigest(),))
+            user = c.fetchone()
+            if user:
+                c.execute("UPDATE api_tokens SET last_used = CURRENT_TIMESTAMP WHERE id = ?", (user[0],))
+                conn.commit()
+            conn.close()
+        if not user:
+            return jsonify({"error": "Invalid or missing API token"}), 401
+        g.api_user_id = user[1]
+        return f(*args, **kwargs)
+    return decorated_function
+
+def api_card_json(card_id, card_path, created_at=None, expired=0):
+    card = {"id": card_id, "filename": os.path.basename(card_path), "expired": bool(expired),
+            "url": None if expired else url_for('api_card_file', card_id=card_id, _external=True)}
+    if created_at is not None:
+        card["created_at"] = created_at
+    return card
+
+@app.route('/api/v1/cards', methods=['POST'])
+@api_token_required
+@rate_limited
+def api_create_card():
+    """Generate a card.
+
+    Either a multipart form (pdf, optional photo, fin_number, output, template,
+    inline) or the PDF itself as the application/pdf request body, with the
+    other parameters in the query string. Returns the extracted fields, the
+    time each pipeline stage took and the card's URL, plus the card bytes
+    (base64) when inline=1. A request repeated with the same Idempotency-Key
+    header returns the first one's card with "replayed": true and status 200.
+    """
+    pdf = request.files.get("pdf")
+    photo = request.files.get("photo")
+    if pdf is None and request.mimetype == "application/pdf":
+        pdf = FileStorage(stream=spool_request_body(), filename="upload.pdf", content_type="application/pdf")
+    if pdf is None or pdf.filename == '':
+        return jsonify({"error": "Send the PDF as a multipart 'pdf' file or as an application/pdf body"}), 400
+    
+    fin_number = request.values.get("fin_number", "")
+    if not fin_number.isdigit() or len(fin_number) != 12:
+        return jsonify({"error": "fin_number must be 12 digits"}), 400
     
+    try:
+        result = run_card_pipeline_once(g.api_user_id, idempotency_key_from_request(), pdf, photo, fin_number,
+                                        request.values.get("output", "png"), request.values.get("template"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    
+    body = api_card_json(result["card_id"], result["card_path"])
+    body.update({"format": result["output"], "template": result["template"],
+                 "fields": result["data"], "timings": result["timings"], "replayed": result.get("replayed", False)})
+    if request.values.get("inline") in ("1", "true"):
+        with open(result["card_path"], "rb") as f:
+            body["content"] = base64.b64encode(f.read()).decode("ascii")
+    return jsonify(body), 200 if body["replayed"] else 201
+
+@app.route('/api/v1/cards', methods=['GET'])
+@api_token_required
+def api_list_cards():
+    """The caller's cards, newest first; pass the returned next_before to get the next page"""
+    limit = min(max(request.args.get("limit", API_PAGE_SIZE, type=int), 1), API_PAGE_MAX)
+    before = request.args.get("before", type=int)
+    
+    # Keyset pagination on (user_id, id): every page is one index range scan
+    query = "SELECT id, card_path, created_at, expired FROM cards_generated WHERE user_id = ?"
+    params = [g.api_user_id]
+    if before is not None:
+        query += " AND id < ?"
+        params.append(before)
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute(query + " ORDER BY id DESC LIMIT ?", params + [limit + 1])
+    rows = c.fetchall()
+    conn.close()
+    
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({"cards": [api_card_json(*row) for row in rows],
+                    "next_before": rows[-1][0] if more else None})
+
+@app.route('/api/v1/cards/<int:card_id>/file')
+@api_token_required
+def api_card_file(card_id):
+    conn = sqlite3.connect(DB_PATH)
+    c = conn.cursor()
+    c.execute("SELECT card_path, content_hash FROM cards_generated WHERE id = ? AND user_id = ? AND expired = 0",
+              (card_id, g.api_user_id))
+    row = c.fetchone()
+    conn.close()
+    if not row or not os.path.exists(row[0]):
+        return jsonify({"error": "Card not found"}), 404
+    card_path, etag = row
+    return send_immutable_file(card_path, card_mimetype(card_path), etag or file_content_hash(card_path),
+                               download_name=os.path.basename(card_path), as_attachment=True)
+
+@app.errorhandler(413)
+def request_too_large(e):
+    message = f"Upload too large, at most {MAX_CONTENT_LENGTH // (1024 * 1024)} MB per request"
+    if request.path.startswith("/api/"):
+        return jsonify({"error": message}), 413
+    return message, 413
+
+start_janitor()
+
+if __name__ == "__main__":
     print("🎉 FREE ID Card Service Started!")
     print("✅ No payment required - Completely FREE")
     print("✅ Access at: http://localhost:5000")
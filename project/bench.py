@@ -0,0 +1,446 @@
+"""Micro-benchmarks for the ID card service.
+
+Run from the project folder:
+
+    python bench.py templates
+"""
+import sys, time
+from io import BytesIO
+
+from flask import render_template, render_template_string
+
+from app import app
+
+
+def timeit(fn, repeat=200):
+    fn()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+# 1. PAGE TEMPLATES
+def bench_templates():
+    """render_template_string (compiled per request) vs cached render_template"""
+    pages = {
+        'login.html': {},
+        'signup.html': {},
+        'generate.html': dict(templates=['fayda_v1'], default_template='fayda_v1'),
+        'forgot_password.html': {},
+        'reset_password.html': {},
+        'dashboard.html': dict(username='demo', email='demo@example.com', phone='0911000000', total_cards=5,
+                               recent_cards=[{"filename": f"id_{i:06x}.png", "created_at": "2024-01-01 10:00:00"}
+                                             for i in range(5)]),
+    }
+    with app.test_request_context('/'):
+        for name, context in pages.items():
+            source = app.jinja_loader.get_source(app.jinja_env, name)[0]
+            before = timeit(lambda: render_template_string(source, **context))
+            after = timeit(lambda: render_template(name, **context))
+            print(f"{name:22s} string: {before:7.3f} ms   cached: {after:7.3f} ms   x{before / after:5.1f}")
+
+
+# 2. PHOTO DECODING
+def bench_photos():
+    """Full decode + per-pixel loop (old) vs draft decode + downscale-first (new)"""
+    import os, tempfile
+    from PIL import Image
+    import app as card_app
+
+    def old_path(path):
+        photo = Image.open(path).convert("RGBA")
+        photo.putdata([(255, 255, 255, 0) if p[0] > 220 and p[1] > 220 and p[2] > 220 else p
+                       for p in photo.getdata()])
+        return photo.resize((310, 400)), photo.resize((100, 135)), photo.size
+
+    def new_path(path):
+        large = card_app.remove_white_background(card_app.load_photo(path, (310, 400)))
+        return large, large.resize((100, 135)), card_app.open_photo_near(path, (310, 400)).size
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "phone.jpg")
+        photo = Image.radial_gradient("L").resize((4000, 3000)).convert("RGB")
+        photo.save(path, quality=90)
+        for name, fn in (("full decode", old_path), ("draft + downscale", new_path)):
+            repeat = 1 if fn is old_path else 20
+            decoded = fn(path)[2]
+            ms = timeit(lambda: fn(path), repeat=repeat)
+            raster_mb = decoded[0] * decoded[1] * 4 / 1024 / 1024
+            print(f"12 MP JPEG {name:18s} {ms:9.1f} ms   decoded {decoded[0]}x{decoded[1]} (~{raster_mb:.1f} MB RGBA)")
+
+
+# 3. BACKGROUND REMOVAL ENGINES
+def bench_bg():
+    """Latency per engine for one photo and a batch of four (cache bypassed)"""
+    from PIL import Image
+    import app as card_app
+
+    photos = [Image.radial_gradient("L").resize((530, 550)).convert("RGBA") for _ in range(4)]
+    for name, engine in card_app.BG_ENGINES.items():
+        try:
+            engine(photos[:1])
+        except Exception as e:
+            print(f"{name:10s} unavailable: {e}")
+            continue
+        single = timeit(lambda: engine(photos[:1]), repeat=10)
+        batch = timeit(lambda: engine(photos), repeat=10)
+        print(f"{name:10s} 1 photo: {single:8.2f} ms   4 photos: {batch:8.2f} ms ({batch / 4:.2f} ms each)")
+    cached = timeit(lambda: card_app.remove_backgrounds(photos[:1]), repeat=100)
+    print(f"cache hit  1 photo: {cached:8.2f} ms")
+
+
+# 4. PREVIEW RENDER
+def bench_preview():
+    """Full resolution PNG card vs low resolution JPEG preview (extraction excluded)"""
+    import os, tempfile
+    from PIL import Image
+    import app as card_app
+
+    data = {"fullname": "ላሜ ባቃላ በኛ\nLami Bekele Begna", "dob": "1995/5/10 | 2003/01/18", "sex": "ወንድ | Male",
+            "nationality": "ኢትዮጵያዊ | Ethiopian", "phone": "0911000000", "region": "ኦሮሚያ\nOromia",
+            "zone": "ሆሮ ጉዱሩ ወለጋ\nHoro Guduru Wellega", "woreda": "ሀባቦ ጉድሩ\nHababo Guduru", "fan": "5874102406892370"}
+    with tempfile.TemporaryDirectory() as tmp:
+        photo = os.path.join(tmp, "phone.jpg")
+        Image.radial_gradient("L").resize((4000, 3000)).convert("RGB").save(photo, quality=90)
+        paths = [photo, photo]
+
+        def full():
+            buffer = BytesIO()
+            card_app.render_card(data, paths, "123456789012").convert("RGB").save(buffer, "PNG")
+            return len(buffer.getvalue())
+
+        for name, fn in (("full PNG", full),
+                         ("preview 25%", lambda: len(card_app.render_card_preview(data, paths, "123456789012"))),
+                         ("preview 50%", lambda: len(card_app.render_card_preview(data, paths, "123456789012", 0.5)))):
+            size = fn()
+            print(f"{name:12s} {timeit(fn, repeat=5):8.1f} ms   {size / 1024:8.1f} KB")
+
+
+# 5. CARD OUTPUT BACKENDS
+def bench_output():
+    """Raster PNG card vs vector PDF card: render + encode time and file size"""
+    import os, tempfile
+    from PIL import Image
+    import app as card_app
+
+    data = {"fullname": "ላሜ ባቃላ በኛ\nLami Bekele Begna", "dob": "1995/5/10 | 2003/01/18", "sex": "ወንድ | Male",
+            "nationality": "ኢትዮጵያዊ | Ethiopian", "phone": "0911000000", "region": "ኦሮሚያ\nOromia",
+            "zone": "ሆሮ ጉዱሩ ወለጋ\nHoro Guduru Wellega", "woreda": "ሀባቦ ጉድሩ\nHababo Guduru", "fan": "5874102406892370"}
+    with tempfile.TemporaryDirectory() as tmp:
+        photo = os.path.join(tmp, "phone.jpg")
+        Image.radial_gradient("L").resize((4000, 3000)).convert("RGB").save(photo, quality=90)
+        paths = [photo, photo]
+
+        def png():
+            buffer = BytesIO()
+            card_app.render_card(data, paths, "123456789012").convert("RGB").save(buffer, "PNG")
+            return len(buffer.getvalue())
+
+        for name, fn in (("PNG", png), ("PDF", lambda: len(card_app.render_card_pdf(data, paths, "123456789012")))):
+            size = fn()
+            print(f"{name:4s} {timeit(fn, repeat=5):8.1f} ms   {size / 1024:8.1f} KB")
+
+
+# 6. PDF PRE-FLIGHT
+def bench_preflight():
+    """Rejecting a wrong PDF in pre-flight vs extracting its images first (old path)"""
+    import os, tempfile, fitz
+    from PIL import Image
+    import app as card_app
+
+    template = card_app.get_template()
+    with tempfile.TemporaryDirectory() as tmp:
+        photo = BytesIO()
+        Image.radial_gradient("L").resize((3000, 3000)).convert("RGB").save(photo, "JPEG", quality=90)
+        doc = fitz.open()
+        for _ in range(6):
+            page = doc.new_page()
+            page.insert_text((72, 72), "Quarterly report")
+            for _ in range(4):  # page1_img3 is what extract_pdf_data OCRs when no FIN is found
+                page.insert_image(page.rect, stream=photo.getvalue())
+        wrong = os.path.join(tmp, "report.pdf")
+        doc.save(wrong)
+
+        def preflight(path):
+            try:
+                card_app.preflight_pdf(path, template)
+                return "accepted"
+            except ValueError as e:
+                return f"rejected: {e}"
+
+        def old_path(path):
+            images = card_app.extract_all_images(path)
+            card_app.extract_pdf_data(path, images, template)
+            for image in images:
+                os.remove(image)
+
+        print(f"wrong PDF   pre-flight {timeit(lambda: preflight(wrong), repeat=50):7.2f} ms   ({preflight(wrong)})")
+        print(f"wrong PDF   extract first {timeit(lambda: old_path(wrong), repeat=5):7.2f} ms")
+        sample = "uploads/temp_1b56d.pdf"
+        if os.path.exists(sample):
+            print(f"Fayda PDF   pre-flight {timeit(lambda: preflight(sample), repeat=50):7.2f} ms   ({preflight(sample)})")
+
+
+# 7. DECODING BUDGETS
+def _zeros_deflated(row_bytes, rows):
+    import zlib
+    z = zlib.compressobj(9)
+    return b"".join(z.compress(b"\0" * row_bytes) for _ in range(rows)) + z.flush()
+
+
+def bench_budget():
+    """Peak RSS while handling adversarial uploads (each small on disk, huge decoded)"""
+    import os, resource, struct, tempfile, zlib, fitz
+    from PIL import Image
+    from werkzeug.datastructures import FileStorage
+    import app as card_app
+
+    side = 20000  # 400 MP: ~1.6 GB as RGBA if decoded
+    with tempfile.TemporaryDirectory() as tmp:
+        # PNG bomb: a grayscale PNG whose zero rows deflate ~1000:1
+        def chunk(kind, data):
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+        png = (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", side, side, 8, 0, 0, 0, 0))
+               + chunk(b"IDAT", _zeros_deflated(side + 1, side)) + chunk(b"IEND", b""))
+
+        # JPEG far over the budget, decoded at 1/8 scale instead
+        jpeg_path = os.path.join(tmp, "huge.jpg")
+        Image.new("L", (12000, 9000)).save(jpeg_path, quality=50)
+        with open(jpeg_path, "rb") as f:
+            jpeg = f.read()
+
+        # PDF whose one image is a 400 MP Flate stream
+        doc = fitz.open()
+        page = doc.new_page()
+        tiny = BytesIO()
+        Image.new("L", (8, 8)).save(tiny, "PNG")
+        xref = page.insert_image(page.rect, stream=tiny.getvalue())
+        doc.update_object(xref, f"<< /Type /XObject /Subtype /Image /Width {side} /Height {side} "
+                                "/ColorSpace /DeviceGray /BitsPerComponent 8 >>")
+        doc.update_stream(xref, _zeros_deflated(side, side), compress=False)
+        doc.xref_set_key(xref, "Filter", "/FlateDecode")
+        pdf_path = os.path.join(tmp, "bomb.pdf")
+        doc.save(pdf_path)
+
+        cases = (
+            ("PNG bomb photo", lambda: card_app.save_user_uploaded_image(
+                FileStorage(stream=BytesIO(png), filename="bomb.png"))),
+            ("108 MP JPEG photo", lambda: card_app.save_user_uploaded_image(
+                FileStorage(stream=BytesIO(jpeg), filename="huge.jpg"))),
+            ("PDF image bomb", lambda: card_app.extract_all_images(pdf_path)),
+        )
+        for name, fn in cases:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            start = time.perf_counter()
+            result = fn()
+            ms = (time.perf_counter() - start) * 1000
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print(f"{name:18s} {ms:8.1f} ms   peak RSS {before:6.0f} -> {peak:6.0f} MB   result: {result}")
+
+
+# 8. RATE LIMITER
+def bench_ratelimit():
+    """Cost of one rate limit check (user + IP bucket) in memory and in a shared SQLite file"""
+    import os, tempfile
+    import app as card_app
+
+    card_app.RATE_LIMIT_RATE, card_app.RATE_LIMIT_BURST = 1e9, 1e9  # never refuse while measuring
+    keys = ["ip:10.0.0.1", "user:1"]
+    print(f"memory       {timeit(lambda: card_app.rate_limit_take(keys), repeat=100000) * 1000:8.2f} us")
+    with tempfile.TemporaryDirectory() as tmp:
+        card_app.RATE_LIMIT_DB = os.path.join(tmp, "ratelimit.db")
+        print(f"shared file  {timeit(lambda: card_app.rate_limit_take(keys), repeat=5000) * 1000:8.2f} us")
+        card_app._rate_limit_db.conn.close()
+        card_app.RATE_LIMIT_DB = ""
+
+
+# 9. TEXT SPRITES
+def bench_text():
+    """Drawing every card field: sprite cache cold (shape + rasterize) vs warm (paste only)"""
+    import app as card_app
+
+    data = {"fullname": "ላሜ ባቃላ በኛ\nLami Bekele Begna", "dob": "1995/5/10 | 2003/01/18", "sex": "ወንድ | Male",
+            "nationality": "ኢትዮጵያዊ | Ethiopian", "phone": "0911000000", "region": "ኦሮሚያ\nOromia",
+            "zone": "ሆሮ ጉዱሩ ወለጋ\nHoro Guduru Wellega", "woreda": "ሀባቦ ጉድሩ\nHababo Guduru", "fan": "5874102406892370"}
+    template = card_app.get_template()
+    job = {"scale": 1.0, "template": template, "boxes": {}, "values": card_app.card_field_values(data, "123456789012")}
+    base = card_app.get_card_template(template)
+
+    def draw_all(cold):
+        if cold:
+            card_app._text_sprites.clear()
+            card_app.TEXT_SPRITE_STATS["bytes"] = 0
+        job["card"] = base.copy()
+        for field in template["layout"]["field_order"]:
+            card_app.draw_field(job, field)
+
+    cold = timeit(lambda: draw_all(True), repeat=20)
+    warm = timeit(lambda: draw_all(False), repeat=20)
+    print(f"cold {cold:7.2f} ms   warm {warm:7.2f} ms   (includes the {base.width}x{base.height} template copy)")
+    print(f"stats {card_app.TEXT_SPRITE_STATS}")
+
+
+# 10. AUTO-FIT
+def bench_fit():
+    """Fitting long names and addresses: cost per card with cold and memoized measurements"""
+    import app as card_app
+
+    template = card_app.get_template()
+    values = [("fullname", f"ወለተማርያም ገብረመድህን ወልደጊዮርጊስ {i}\nWoletemariam Gebremedhin Woldegiorgis {i}", 37, 8)
+              for i in range(50)]
+    values += [("region", "ደቡብ ብሔሮች ብሔረሰቦችና ሕዝቦች\nSouthern Nations, Nationalities and Peoples", 28, 5),
+               ("zone", "ሆሮ ጉዱሩ ወለጋ\nHoro Guduru Wellega", 28, 5)]
+
+    def fit_all():
+        return [card_app.field_font_size(template, *value) for value in values]
+
+    card_app.text_extent.cache_clear()
+    start = time.perf_counter()
+    sizes = fit_all()
+    cold = (time.perf_counter() - start) * 1000 / 50
+    warm = timeit(fit_all, repeat=200) / 50
+    print(f"per card  cold {cold:6.3f} ms   memoized {warm:6.3f} ms   sizes {sorted(set(sizes))}")
+    print(f"measurements {card_app.text_extent.cache_info()}")
+
+
+# 11. ETHIOPIAN CALENDAR
+def bench_ethiopian():
+    """Check the conversion table against ethiopian_date for every day in range, then time both"""
+    from datetime import date, timedelta
+    import numpy as np
+    from ethiopian_date import EthiopianDateConverter
+    import app as card_app
+
+    first, last = card_app.ETHIOPIAN_TABLE_RANGE
+    days = [first + timedelta(n) for n in range((last - first).days + 1)]
+    round_trip, agree, differ, unrepresentable, pagume_6 = [], [], [], {"pagume": 0, "other": 0}, 0
+    for day, (year, month, eth_day) in zip(days, card_app.to_ethiopian_batch(days).tolist()):
+        if card_app.to_gregorian(year, month, eth_day) != day or card_app.to_ethiopian(day) != (year, month, eth_day):
+            round_trip.append(day)
+        pagume_6 += (month, eth_day) == (13, 6)
+        try:
+            expected = EthiopianDateConverter.to_ethiopian(day.year, day.month, day.day)
+        except ValueError:
+            # The library returns datetime.date: no month 13, no 30 Yekatit
+            unrepresentable["pagume" if month == 13 else "other"] += 1
+            continue
+        if (expected.year, expected.month, expected.day) == (year, month, eth_day):
+            agree.append(day)
+        else:
+            differ.append(day)
+    print(f"{len(days)} days: round trip errors {len(round_trip)}, {pagume_6} Pagume 6 days")
+    print(f"library agrees on {len(agree)}, can not return {unrepresentable}, differs on {len(differ)}"
+          + (f" ({differ[0]} .. {differ[-1]})" if differ else ""))
+
+    sample = agree[::7][:10000]
+    batch = np.array(sample, dtype="datetime64[D]")
+    library = timeit(lambda: [EthiopianDateConverter.date_to_ethiopian(day) for day in sample], repeat=3) / len(sample)
+    table = timeit(lambda: [card_app.to_ethiopian(day) for day in sample], repeat=20) / len(sample)
+    vector = timeit(lambda: card_app.to_ethiopian_batch(batch), repeat=200) / len(sample)
+    print(f"per date  library {library * 1000:7.3f} us   table {table * 1000:7.3f} us   batch {vector * 1000:7.4f} us")
+    print(f"card date texts (cached) {timeit(lambda: card_app.card_date_values(date.today()), 100000) * 1000:7.3f} us")
+
+
+# 12. QR BLOCK
+def bench_qr():
+    """Card QR block: qrcode's PIL image vs segno matrix + NumPy, uncached and cached"""
+    import random
+    import qrcode
+    from PIL import Image
+    import app as card_app
+
+    (x, y), size, fields = card_app.get_template()["layout"]["qr"]
+    values = {"fin": "123456789012", "fan": "5874102406892370", "serial": " 12345678"}
+    payloads = [card_app.qr_payload(dict(values, serial=f" {random.randint(10000000, 99999999)}"), fields)
+                for _ in range(200)]
+    card = Image.new("RGBA", (2130, 655), "white")
+
+    def with_qrcode(payload):
+        code = qrcode.make(payload, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=3, border=2)
+        card.paste(code.get_image().resize((size, size), Image.NEAREST), (x, y))
+
+    def with_segno(payload):
+        card.paste(card_app.qr_image(payload, size), (x, y))
+
+    print(f"qrcode + PIL      {timeit(lambda: [with_qrcode(p) for p in payloads], repeat=3) / len(payloads):7.3f} ms")
+    card_app.qr_image.cache_clear()
+    start = time.perf_counter()
+    for payload in payloads:
+        with_segno(payload)
+    print(f"segno + NumPy     {(time.perf_counter() - start) * 1000 / len(payloads):7.3f} ms")
+    print(f"cached (re-render) {timeit(lambda: with_segno(payloads[0]), repeat=1000):6.3f} ms")
+
+
+# 13. FACE AUTO-CROP
+def bench_facecrop():
+    """Saving a phone photo: without auto-crop, with it (detection), and with a cached detection"""
+    import os
+    from PIL import Image, ImageFilter
+    from werkzeug.datastructures import FileStorage
+    import app as card_app
+
+    sample = "uploads/temp_1b56d.pdf"
+    if not os.path.exists(sample):
+        print(f"needs {sample} for a face")
+        return
+    images = card_app.extract_all_images(sample)
+    face = Image.open(images[0]).convert("RGB")  # the ID photo printed on the Fayda PDF
+    for image in images:
+        os.remove(image)
+
+    photos = {}
+    for name, size, zoom, at in (("portrait 12 MP", (3000, 4000), 3, (1000, 900)),
+                                 ("landscape 12 MP", (4000, 3000), 2, (2300, 700))):
+        scene = Image.radial_gradient("L").resize(size).convert("RGB").filter(ImageFilter.GaussianBlur(4))
+        scene.paste(face.resize((face.width * zoom, face.height * zoom), Image.LANCZOS), at)
+        buffer = BytesIO()
+        scene.save(buffer, "JPEG", quality=90)
+        photos[name] = buffer.getvalue()
+    photos["cropped (as asked)"] = BytesIO()
+    face.save(photos["cropped (as asked)"], "JPEG", quality=90)
+    photos["cropped (as asked)"] = photos["cropped (as asked)"].getvalue()
+
+    def save_photo(data):
+        path = card_app.save_user_uploaded_image(FileStorage(stream=BytesIO(data), filename="phone.jpg"))
+        size = Image.open(path).size
+        os.remove(path)
+        return size
+
+    card_app.get_face_detector()  # loaded once per worker, not per photo
+    for name, data in photos.items():
+        card_app.PHOTO_AUTO_CROP = False
+        plain = timeit(lambda: save_photo(data), repeat=5)
+        card_app.PHOTO_AUTO_CROP = True
+        card_app._face_crops.clear()
+        start = time.perf_counter()
+        size = save_photo(data)
+        detect = (time.perf_counter() - start) * 1000
+        cached = timeit(lambda: save_photo(data), repeat=5)
+        box = next(reversed(card_app._face_crops.values()))
+        box = "no crop" if box is None else "box " + " ".join(f"{v:.2f}" for v in box)
+        print(f"{name:19s} plain {plain:7.1f} ms   auto-crop {detect:7.1f} ms   cached {cached:7.1f} ms   "
+              f"-> {size[0]}x{size[1]} ({box})")
+
+
+BENCHMARKS = {
+    'templates': bench_templates,
+    'photos': bench_photos,
+    'bg': bench_bg,
+    'preview': bench_preview,
+    'output': bench_output,
+    'preflight': bench_preflight,
+    'budget': bench_budget,
+    'ratelimit': bench_ratelimit,
+    'text': bench_text,
+    'fit': bench_fit,
+    'ethiopian': bench_ethiopian,
+    'qr': bench_qr,
+    'facecrop': bench_facecrop,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f"== {name} ==")
+        BENCHMARKS[name]()
@@ -0,0 +1,19 @@
+import os
+import shutil
+import sys
+import tempfile
+
+PROJECT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py works relative to the current directory and creates its folders and
+# database there when imported, so the tests run it in a scratch directory
+WORKDIR = tempfile.mkdtemp(prefix="fayda-tests-")
+for name in ("fonts", "layouts", "static"):
+    os.symlink(os.path.join(PROJECT, name), os.path.join(WORKDIR, name))
+os.chdir(WORKDIR)
+sys.path.insert(0, PROJECT)
+
+
+def pytest_sessionfinish(session, exitstatus):
+    os.chdir(PROJECT)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
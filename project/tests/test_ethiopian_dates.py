@@ -0,0 +1,68 @@
+"""Gregorian <-> Ethiopian conversion: round trip over the table and agreement with ethiopian_date"""
+from datetime import date, timedelta
+
+import pytest
+from ethiopian_date import EthiopianDateConverter
+
+import app
+
+FIRST, LAST = app.ETHIOPIAN_TABLE_RANGE
+DAYS = [FIRST + timedelta(n) for n in range((LAST - FIRST).days + 1)]
+
+
+def test_round_trip_over_the_table():
+    batch = app.to_ethiopian_batch(DAYS).tolist()
+    for day, ethiopian in zip(DAYS, batch):
+        assert app.to_ethiopian(day) == tuple(ethiopian)
+        assert app.to_gregorian(*ethiopian) == day
+
+
+@pytest.mark.parametrize("day", [FIRST - timedelta(1), LAST + timedelta(1), date(1, 1, 1), date(9999, 12, 31)])
+def test_round_trip_outside_the_table(day):
+    assert app.to_gregorian(*app.to_ethiopian(day)) == day
+    assert app.to_ethiopian_batch([day]).tolist() == [list(app.to_ethiopian(day))]
+
+
+@pytest.mark.parametrize("day, ethiopian", [
+    (date(2023, 9, 5), (2015, 12, 30)),   # last day of Nehase
+    (date(2023, 9, 6), (2015, 13, 1)),    # Pagume 1
+    (date(2023, 9, 11), (2015, 13, 6)),   # Pagume 6 of a leap year
+    (date(2023, 9, 12), (2016, 1, 1)),    # new year after a leap year
+    (date(2024, 9, 10), (2016, 13, 5)),   # last Pagume day of a common year
+    (date(2024, 9, 11), (2017, 1, 1)),    # new year after a common year
+    (date(2024, 2, 29), (2016, 6, 21)),   # Gregorian leap day
+])
+def test_boundaries(day, ethiopian):
+    assert app.to_ethiopian(day) == ethiopian
+    assert app.to_gregorian(*ethiopian) == day
+    assert EthiopianDateConverter.to_gregorian(*ethiopian) == day
+
+
+def test_library_agrees_to_gregorian():
+    # The library is off by a day before Gregorian 1908 and misses that 2100 is
+    # not a Gregorian leap year, so compare Ethiopian 1901 - 2092 only
+    for year in range(1901, 2093):
+        for month in range(1, 14):
+            for day in range(1, (6 if year % 4 == 3 else 5) + 1 if month == 13 else 31):
+                assert app.to_gregorian(year, month, day) == EthiopianDateConverter.to_gregorian(year, month, day)
+
+
+def test_library_agrees_to_ethiopian():
+    for day in DAYS:
+        if not date(1908, 9, 12) <= day < date(2100, 3, 1):
+            continue
+        try:
+            expected = EthiopianDateConverter.date_to_ethiopian(day)
+        except ValueError:
+            # Returned as a datetime.date, so Pagume and 29/30 Yekatit do not exist there
+            month, eth_day = app.to_ethiopian(day)[1:]
+            assert month == 13 or eth_day > 28
+            continue
+        assert app.to_ethiopian(day) == (expected.year, expected.month, expected.day)
+
+
+@pytest.mark.parametrize("ethiopian", [(2016, 13, 6), (2015, 13, 7), (2016, 14, 1), (2016, 0, 1), (2016, 1, 31),
+                                       (2016, 1, 0)])
+def test_invalid_dates(ethiopian):
+    with pytest.raises(ValueError):
+        app.to_gregorian(*ethiopian)
@@ -0,0 +1,84 @@
+"""Adversarial uploads (small on disk, huge when decoded) keep a worker's peak RSS bounded"""
+import os
+import struct
+import subprocess
+import sys
+import zlib
+from io import BytesIO
+
+import fitz
+from PIL import Image
+
+from conftest import PROJECT
+
+SIDE = 10000  # 100 MP: ~400 MB as RGBA if decoded
+MAX_GROWTH_MB = 64
+
+
+def zeros_deflated(row_bytes, rows):
+    z = zlib.compressobj(9)
+    return b"".join(z.compress(b"\0" * row_bytes) for _ in range(rows)) + z.flush()
+
+
+def peak_rss_growth(tmp_path, code):
+    """Run `code` with app imported in a fresh interpreter; (peak RSS growth in MB, value of `result`)"""
+    script = ("import resource, app\n"
+              "from io import BytesIO\n"
+              "from werkzeug.datastructures import FileStorage\n"
+              "before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+              f"{code}\n"
+              "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before, repr(result))\n")
+    out = subprocess.run([sys.executable, "-c", script], cwd=os.getcwd(), capture_output=True, text=True,
+                         env=dict(os.environ, PYTHONPATH=PROJECT), timeout=120)
+    assert out.returncode == 0, out.stderr
+    growth, result = out.stdout.strip().splitlines()[-1].split(" ", 1)
+    return int(growth) / 1024, result
+
+
+def test_png_bomb_photo_is_refused(tmp_path):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    png = tmp_path / "bomb.png"
+    png.write_bytes(b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", SIDE, SIDE, 8, 0, 0, 0, 0))
+                    + chunk(b"IDAT", zeros_deflated(SIDE + 1, SIDE)) + chunk(b"IEND", b""))
+    growth, result = peak_rss_growth(tmp_path, (
+        f"data = open({str(png)!r}, 'rb').read()\n"
+        "result = app.save_user_uploaded_image(FileStorage(stream=BytesIO(data), filename='bomb.png'))"))
+    assert result == "None"
+    assert growth < MAX_GROWTH_MB
+
+
+def test_huge_jpeg_photo_is_decoded_small(tmp_path):
+    jpeg = tmp_path / "huge.jpg"
+    Image.new("L", (SIDE, SIDE)).save(jpeg, quality=50)
+    growth, result = peak_rss_growth(tmp_path, (
+        f"data = open({str(jpeg)!r}, 'rb').read()\n"
+        "path = app.save_user_uploaded_image(FileStorage(stream=BytesIO(data), filename='huge.jpg'))\n"
+        "result = app.Image.open(path).size"))
+    width, height = eval(result)
+    assert width * height <= 4 * 530 * 550
+    assert growth < MAX_GROWTH_MB
+
+
+def test_pdf_image_bomb_is_skipped(tmp_path):
+    doc = fitz.open()
+    page = doc.new_page()
+    tiny = BytesIO()
+    Image.new("L", (8, 8)).save(tiny, "PNG")
+    xref = page.insert_image(page.rect, stream=tiny.getvalue())
+    doc.update_object(xref, f"<< /Type /XObject /Subtype /Image /Width {SIDE} /Height {SIDE} "
+                            "/ColorSpace /DeviceGray /BitsPerComponent 8 >>")
+    doc.update_stream(xref, zeros_deflated(SIDE, SIDE), compress=False)
+    doc.xref_set_key(xref, "Filter", "/FlateDecode")
+    pdf = tmp_path / "bomb.pdf"
+    doc.save(pdf)
+    growth, result = peak_rss_growth(tmp_path, f"result = app.extract_all_images({str(pdf)!r})")
+    assert result == "[]"
+    assert growth < MAX_GROWTH_MB
+
+
+def test_oversized_request_is_refused():
+    import app
+    client = app.app.test_client()
+    body = {"username": "x" * (app.MAX_CONTENT_LENGTH + 1), "password": "x"}
+    assert client.post("/login", data=body).status_code == 413
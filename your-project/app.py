@@ -1,7 +1,7 @@
 from flask import Flask, request, send_file, render_template_string, redirect, url_for, flash, session
 import fitz  # PyMuPDF
 from PIL import Image, ImageDraw, ImageFont
-import os, uuid, random, re, shutil, json, hashlib, sqlite3, time
+import os, uuid, random, re, shutil, json, hashlib, sqlite3, time, threading
 import pytesseract
 from datetime import datetime, timedelta
 from ethiopian_date import EthiopianDateConverter
@@ -21,9 +21,22 @@ DB_PATH = os.path.join(os.getcwd(), "database.db")
 FONT_PATH = "fonts/AbyssinicaSIL-Regular.ttf"
 TEMPLATE_PATH = "static/id_card_template.png"
 
+# Field layout (PDF source rects and card positions), see compile_layout()
+LAYOUT_PATH = "layouts/fayda_v1.json"
+LAYOUT_VERSION = 1
+
 # FREE SERVICE - NO PAYMENT REQUIRED
 FREE_MODE = True
 
+# How long each kind of file is kept before the janitor removes it (seconds)
+ARTIFACT_TTL = {
+    "upload": 3600,
+    "image": 3600,
+    "card": 7 * 24 * 3600,
+}
+JANITOR_INTERVAL = 60
+JANITOR_BATCH_SIZE = 200
+
 for folder in [UPLOAD_FOLDER, IMG_FOLDER, CARD_FOLDER]:
     os.makedirs(folder, exist_ok=True)
 
@@ -62,9 +75,17 @@ def init_db():
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER NOT NULL,
                   card_path TEXT NOT NULL,
+                  expired INTEGER DEFAULT 0,
                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
     
+    c.execute('''CREATE TABLE IF NOT EXISTS artifacts
+                 (path TEXT PRIMARY KEY,
+                  kind TEXT NOT NULL,
+                  size INTEGER DEFAULT 0,
+                  expires_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_artifacts_expires ON artifacts (expires_at)")
+    
     c.execute('''CREATE TABLE IF NOT EXISTS password_resets
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER NOT NULL,
@@ -73,6 +94,10 @@ def init_db():
                   used INTEGER DEFAULT 0,
                   FOREIGN KEY (user_id) REFERENCES users (id))''')
     
+    c.execute("PRAGMA table_info(cards_generated)")
+    if 'expired' not in [col[1] for col in c.fetchall()]:
+        c.execute("ALTER TABLE cards_generated ADD COLUMN expired INTEGER DEFAULT 0")
+    
     conn.commit()
     conn.close()
 
@@ -93,16 +118,73 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def clear_old_files():
-    for folder in [UPLOAD_FOLDER, IMG_FOLDER, CARD_FOLDER]:
-        for filename in os.listdir(folder):
-            file_path = os.path.join(folder, filename)
+# Artifact expiry: every file we write is recorded in the artifacts table with
+# its expiry time, so the janitor only ever reads the rows that are due.
+JANITOR_STATS = {"passes": 0, "files_deleted": 0, "bytes_reclaimed": 0, "cards_expired": 0}
+_janitor_started = False
+_janitor_lock = threading.Lock()
+
+def register_artifacts(paths, kind):
+    expires_at = time.time() + ARTIFACT_TTL[kind]
+    rows = [(path, kind, os.path.getsize(path), expires_at) for path in paths if path and os.path.exists(path)]
+    if not rows:
+        return
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.executemany("INSERT OR REPLACE INTO artifacts (path, kind, size, expires_at) VALUES (?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+def run_janitor_pass(now=None, batch_size=JANITOR_BATCH_SIZE):
+    """Delete expired artifacts in bounded batches; returns (files_deleted, bytes_reclaimed)"""
+    now = now or time.time()
+    total_files = total_bytes = 0
+    while True:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT path, kind, size FROM artifacts WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                  (now, batch_size))
+        batch = c.fetchall()
+        c.executemany("DELETE FROM artifacts WHERE path = ?", [(row[0],) for row in batch])
+        cards = [(row[0],) for row in batch if row[1] == "card"]
+        c.executemany("UPDATE cards_generated SET expired = 1 WHERE card_path = ?", cards)
+        conn.commit()
+        conn.close()
+        
+        for path, kind, size in batch:
             try:
-                if os.path.isfile(file_path):
-                    if os.path.getmtime(file_path) < time.time() - 3600:
-                        os.remove(file_path)
+                os.remove(path)
+                total_files += 1
+                total_bytes += size
             except:
                 pass
+        JANITOR_STATS["cards_expired"] += len(cards)
+        
+        if len(batch) < batch_size:
+            break
+    
+    JANITOR_STATS["passes"] += 1
+    JANITOR_STATS["files_deleted"] += total_files
+    JANITOR_STATS["bytes_reclaimed"] += total_bytes
+    if total_files:
+        print(f"Janitor: deleted {total_files} files, reclaimed {total_bytes / 1024 / 1024:.1f} MB")
+    return total_files, total_bytes
+
+def _janitor_loop():
+    while True:
+        try:
+            run_janitor_pass()
+        except Exception as e:
+            print(f"Janitor error: {e}")
+        time.sleep(JANITOR_INTERVAL)
+
+def start_janitor():
+    global _janitor_started
+    with _janitor_lock:
+        if _janitor_started:
+            return
+        threading.Thread(target=_janitor_loop, name="janitor", daemon=True).start()
+        _janitor_started = True
 
 def save_user_uploaded_image(uploaded_file):
     if not uploaded_file or uploaded_file.filename == '':
@@ -125,10 +207,14 @@ def save_user_uploaded_image(uploaded_file):
                 newData.append(item)
         img.putdata(newData)
         img.save(save_path, "PNG")
+        register_artifacts([save_path], "image")
         return save_path
     except Exception as e:
         print(f"Error: {e}")
-        return save_path if os.path.exists(save_path) else None
+        if os.path.exists(save_path):
+            register_artifacts([save_path], "image")
+            return save_path
+        return None
 
 def prepare_images_for_card(extracted_images, user_photo_path):
     image_paths = []
@@ -158,43 +244,82 @@ def extract_all_images(pdf_path):
                     f.write(image_bytes)
                 image_paths.append(path)
         doc.close()
+        register_artifacts(image_paths, "image")
         return image_paths
     except Exception as e:
         print(f"PDF Error: {e}")
         return []
 
+def compile_layout(path):
+    """Read a layout file and compile it into an extraction plan and a render plan.
+
+    Each field in the file may have a "source" on the uploaded PDF (a text
+    "rect", or a "regex" over the page text with an optional "default"),
+    "replace" pairs applied to the extracted text, and its place on the card:
+    "position" and "size" plus either "spacing" or a rotation "angle".
+    Fields are drawn in file order. This runs once at startup, so requests
+    only walk the compiled tuples.
+    """
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+    if spec.get("version") != LAYOUT_VERSION:
+        raise ValueError(f"{path}: unsupported layout version {spec.get('version')!r}")
+    
+    extraction, text_fields, rotated_fields = [], [], []
+    for field in spec["fields"]:
+        name = field["name"]
+        source = field.get("source")
+        if source:
+            if "rect" in source:
+                compiled = fitz.Rect(source["rect"])
+            else:
+                compiled = (re.compile(source["regex"]), source.get("default", ""))
+            replace = tuple((old, new) for old, new in field.get("replace", []))
+            extraction.append((name, compiled, replace))
+        if "angle" in field:
+            rotated_fields.append((name, tuple(field["position"]), field["size"], field["angle"]))
+        else:
+            text_fields.append((name, tuple(field["position"]), field["size"], field.get("spacing", 4)))
+    
+    photos = {name: (tuple(slot["position"]), tuple(slot["size"])) for name, slot in spec["photos"].items()}
+    return {"name": spec["name"], "version": spec["version"], "extraction": extraction,
+            "photos": photos, "text_fields": text_fields, "rotated_fields": rotated_fields}
+
+def run_extraction_plan(page, full_text, plan):
+    """Field values of a PDF page following a compiled extraction plan"""
+    data = {}
+    for name, source, replace in plan:
+        if isinstance(source, fitz.Rect):
+            text = page.get_textbox(source).strip()
+        else:
+            pattern, default = source
+            match = pattern.search(full_text)
+            if not match:
+                data[name] = default
+                continue
+            text = match.group(0).strip()
+        for old, new in replace:
+            text = text.replace(old, new)
+        data[name] = text
+    return data
+
+# Card layout on the full resolution template
+LAYOUT = compile_layout(LAYOUT_PATH)
+EXTRACTION_PLAN = LAYOUT["extraction"]
+PHOTO_SLOTS = LAYOUT["photos"]              # name: (position, size)
+TEXT_FIELDS = LAYOUT["text_fields"]         # (field, position, font size, line spacing)
+
 def extract_pdf_data(pdf_path, image_paths):
     try:
         doc = fitz.open(pdf_path)
         page = doc[0]
         full_text = page.get_text("text")
-        
-        fin_matches = re.findall(r"\b\d{4}\s\d{4}\s\d{4}\b", full_text)
-        fin_number = fin_matches[-1].strip() if fin_matches else "Not Found"
-        
-        fan_matches = re.findall(r"\b\d{4}\s\d{4}\s\d{4}\s\d{4}\b", full_text)
-        fan_number = fan_matches[0].replace(" ", "") if fan_matches else "Not Found"
-        
-        data = {
-            "fullname": page.get_textbox(fitz.Rect(50, 360, 300, 372)).strip().replace("| ", "\n"),
-            "dob": page.get_textbox(fitz.Rect(50, 430, 300, 435)).strip(),
-            "sex": page.get_textbox(fitz.Rect(50, 500, 300, 510)).strip(),
-            "nationality": page.get_textbox(fitz.Rect(50, 560, 300, 575)).strip(),
-            "phone": page.get_textbox(fitz.Rect(50, 600, 300, 625)).strip(),
-            "region": page.get_textbox(fitz.Rect(50, 400, 300, 410)).strip().replace("| ", "\n"),
-            "zone": page.get_textbox(fitz.Rect(50, 460, 400, 470)).strip().replace("| ", "\n"),
-            "woreda": page.get_textbox(fitz.Rect(50, 527, 300, 537)).strip().replace("| ", "\n"),
-            "fan": fan_number,
-        }
+        data = run_extraction_plan(page, full_text, EXTRACTION_PLAN)
         doc.close()
         return data
     except Exception as e:
         print(f"Extract Error: {e}")
-        return {
-            "fullname": "Not Found", "dob": "Not Found", "sex": "Not Found",
-            "nationality": "Not Found", "phone": "Not Found", "region": "Not Found",
-            "zone": "Not Found", "woreda": "Not Found", "fan": "Not Found"
-        }
+        return {name: "Not Found" for name, _, _ in EXTRACTION_PLAN}
 
 def generate_card(data, image_paths, fin_number):
     try:
@@ -234,44 +359,35 @@ def generate_card(data, image_paths, fin_number):
                             newData.append(item)
                     img.putdata(newData)
                     
-                    if i == 0:  # Original
-                        p_large = img.resize((310, 400))
-                        card.paste(p_large, (65, 200), p_large)
-                        p_small = img.resize((100, 135))
-                        card.paste(p_small, (800, 450), p_small)
-                    else:  # New
-                        new_resized = img.resize((530, 550))
-                        card.paste(new_resized, (1550, 30), new_resized)
+                    slots = ["original", "original_small"] if i == 0 else ["new"]
+                    for slot in slots:
+                        position, size = PHOTO_SLOTS[slot]
+                        resized = img.resize(size)
+                        card.paste(resized, position, resized)
                 except:
                     pass
         
         # Fonts
-        try:
-            font = ImageFont.truetype(FONT_PATH, 37)
-            small = ImageFont.truetype(FONT_PATH, 32)
-            small_multiline = ImageFont.truetype(FONT_PATH, 28)
-            fin_font = ImageFont.truetype(FONT_PATH, 25)
-            iss_font = ImageFont.truetype(FONT_PATH, 25)
-            sn_font = ImageFont.truetype(FONT_PATH, 26)
-        except:
-            font = small = small_multiline = fin_font = iss_font = sn_font = ImageFont.load_default()
+        fonts = {}
+        for _, _, size, _ in TEXT_FIELDS:
+            try:
+                fonts[size] = ImageFont.truetype(FONT_PATH, size)
+            except:
+                fonts[size] = ImageFont.load_default()
         
         # Text
-        draw.text((1265, 545), fin_number, fill="black", font=fin_font)
-        draw.text((405, 170), data["fullname"], fill="black", font=font, spacing=8)
-        draw.text((405, 305), data["dob"], fill="black", font=small)
-        draw.text((405, 375), data["sex"], fill="black", font=small)
-        draw.text((1130, 165), data["nationality"], fill="black", font=small)
-        draw.text((1130, 235), data["region"], fill="black", font=small_multiline, spacing=5)
-        draw.text((1130, 315), data["zone"], fill="black", font=small_multiline, spacing=5)
-        draw.text((1130, 390), data["woreda"], fill="black", font=small_multiline, spacing=5)
-        draw.text((1130, 65), data["phone"], fill="black", font=small)
-        draw.text((470, 500), data["fan"], fill="black", font=small)
-        draw.text((405, 440), expiry_full, fill="black", font=small)
-        draw.text((1930, 595), f" {random.randint(10000000, 99999999)}", fill="black", font=sn_font)
+        values = dict(data)
+        values.update({
+            "fin": fin_number,
+            "expiry": expiry_full,
+            "serial": f" {random.randint(10000000, 99999999)}",
+        })
+        for field, position, size, spacing in TEXT_FIELDS:
+            draw.text(position, values.get(field, ""), fill="black", font=fonts[size], spacing=spacing)
         
         out_path = os.path.join(CARD_FOLDER, f"id_{uuid.uuid4().hex[:6]}.png")
         card.convert("RGB").save(out_path)
+        register_artifacts([out_path], "card")
         return out_path
     except Exception as e:
         print(f"Card Gen Error: {e}")
@@ -279,6 +395,7 @@ def generate_card(data, image_paths, fin_number):
         simple_card = Image.new("RGB", (2100, 1500), color="white")
         out_path = os.path.join(CARD_FOLDER, f"id_{uuid.uuid4().hex[:6]}.png")
         simple_card.save(out_path)
+        register_artifacts([out_path], "card")
         return out_path
 
 # 5. ROUTES
@@ -492,7 +609,7 @@ def dashboard():
     c.execute("SELECT COUNT(*) FROM cards_generated WHERE user_id = ?", (session['user_id'],))
     total_cards = c.fetchone()[0]
     
-    c.execute('''SELECT card_path, created_at FROM cards_generated 
+    c.execute('''SELECT card_path, created_at, expired FROM cards_generated 
                  WHERE user_id = ? ORDER BY created_at DESC LIMIT 5''',
               (session['user_id'],))
     recent_cards = c.fetchall()
@@ -506,7 +623,7 @@ def dashboard():
                 <tr>
                     <td>{filename}</td>
                     <td>{card[1][:19]}</td>
-                    <td><a href="/download-card/{filename}" target="_blank">Download</a></td>
+                    <td>{'Expired' if card[2] else f'<a href="/download-card/{filename}" target="_blank">Download</a>'}</td>
                 </tr>
             '''
     else:
@@ -605,6 +722,7 @@ def generate():
         
         pdf_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4().hex[:5]}.pdf")
         pdf.save(pdf_path)
+        register_artifacts([pdf_path], "upload")
         
         try:
             extracted_images = extract_all_images(pdf_path)
@@ -715,8 +833,9 @@ def server_error(e):
     '''), 500
 
 # 7. STARTUP
+start_janitor()
+
 if __name__ == "__main__":
-    clear_old_files()
     port = int(os.environ.get("PORT", 5000))
     print(f"🚀 Server starting on port {port}")
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file